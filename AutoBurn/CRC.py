@@ -1,4 +1,7 @@
+import os
 import sys
+import struct
+import binascii
 
 # CRC-16-CCITT
 crc16_table = [
@@ -37,7 +40,7 @@ crc16_table = [
 ]
 
 
-def calc_crc16(data, crc=0):
+def calc_crc16_py(data, crc=0):
     for char in bytearray(data):
         crctbl_idx = ((crc >> 8) ^ char) & 0xff
         crc = ((crc << 8) ^ crc16_table[crctbl_idx]) & 0xffff
@@ -88,8 +91,83 @@ crc32_table = [
 ]
 
 
-def calc_crc32(data, crc=0):
+def calc_crc32_py(data, crc=0):
     for char in bytearray(data):
         crctbl_idx = ((crc >> 8) ^ char) & 0xff
         crc = ((crc << 8) ^ crc32_table[crctbl_idx]) & 0xffffffff
     return crc & 0xffffffff
+
+
+# Accelerated backends. calc_crc16_py/calc_crc32_py above are kept as the
+# reference implementation; set AUTOBURN_CRC_BACKEND=python to force them.
+
+def _as_buffer(data):
+    # The reference functions accept any iterable of ints (lists included),
+    # the fast paths need a buffer
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return bytes(data)
+
+
+def _calc_crc16_binascii(data, crc=0):
+    # binascii.crc_hqx is CRC-16-CCITT with the same polynomial and takes
+    # any contiguous buffer (bytes, bytearray, memoryview) without copying
+    return binascii.crc_hqx(_as_buffer(data), crc)
+
+
+# The CRC-32 above is a non-reflected update over the reflected IEEE table,
+# so zlib.crc32 cannot be used. The update is linear over GF(2):
+#   crc' = L(crc) ^ T[b],  L(c) = ((c << 8) & 0xffffffff) ^ T[(c >> 8) & 0xff]
+# which allows slicing by 8: eight data bytes and the four state bytes are
+# folded in with one table lookup each.
+_crc32_slice_tables = None
+
+
+def _crc32_shift(c):
+    return ((c << 8) & 0xffffffff) ^ crc32_table[(c >> 8) & 0xff]
+
+
+def _crc32_build_slice_tables():
+    global _crc32_slice_tables
+    data_tables = [list(crc32_table)]
+    for _ in range(7):
+        data_tables.append([_crc32_shift(c) for c in data_tables[-1]])
+    state_tables = []
+    for k in range(4):
+        table = []
+        for v in range(256):
+            c = v << (8 * k)
+            for _ in range(8):
+                c = _crc32_shift(c)
+            table.append(c)
+        state_tables.append(table)
+    # data_tables[m] applies L^m, so the first byte of a slice uses L^7
+    _crc32_slice_tables = state_tables + data_tables[::-1]
+    return _crc32_slice_tables
+
+
+def _calc_crc32_sliced(data, crc=0):
+    tables = _crc32_slice_tables or _crc32_build_slice_tables()
+    s0, s1, s2, s3, t0, t1, t2, t3, t4, t5, t6, t7 = tables
+    view = memoryview(_as_buffer(data)).cast('B')
+    n8 = len(view) & ~7
+    crc &= 0xffffffff
+    for b0, b1, b2, b3, b4, b5, b6, b7 in struct.iter_unpack('8B', view[:n8]):
+        crc = (s0[crc & 0xff] ^ s1[(crc >> 8) & 0xff] ^
+               s2[(crc >> 16) & 0xff] ^ s3[crc >> 24] ^
+               t0[b0] ^ t1[b1] ^ t2[b2] ^ t3[b3] ^
+               t4[b4] ^ t5[b5] ^ t6[b6] ^ t7[b7])
+    for char in view[n8:]:
+        crc = ((crc << 8) ^ crc32_table[((crc >> 8) ^ char) & 0xff]) & 0xffffffff
+    return crc
+
+
+BACKEND = os.environ.get("AUTOBURN_CRC_BACKEND", "fast")
+
+if BACKEND == "python":
+    calc_crc16 = calc_crc16_py
+    calc_crc32 = calc_crc32_py
+else:
+    BACKEND = "fast"
+    calc_crc16 = _calc_crc16_binascii
+    calc_crc32 = _calc_crc32_sliced
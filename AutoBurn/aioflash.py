@@ -0,0 +1,339 @@
+"""
+asyncio flashing API. One event loop can drive many ports: every session
+waits on its serial fd with loop.add_reader instead of a polling thread.
+
+    async def main():
+        with Fwpkg("app.fwpkg") as fwpkg:
+            results = await flash_many(["/dev/ttyUSB0", "/dev/ttyUSB1"], fwpkg)
+
+POSIX only, since it needs a selectable serial fd.
+"""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+
+import serial
+
+from .events import SESSION_END, EventEmitter
+from .frame import FrameParser, download_frame, erase_size, handshake_frame, reset_frame
+from .metrics import SessionMetrics
+from .pymodem import (ACK, C, CAN, EOT, NAK, RetryPolicy, XferStats, YMODEM_C_TIMEOUT,
+                      ymodem_data_blks, ymodem_info_blk)
+from .ws63flash import (HANDSHAKE_ACK, HANDSHAKE_INTERVAL, RESET_PULSE, RESET_TIMEOUT,
+                        UART_READ_TIMEOUT)
+
+
+class AsyncSerial:
+    """
+    Serial port opened non-blocking, with received bytes collected by an
+    event loop reader callback. Must be created inside a running loop.
+    """
+
+    def __init__(self, port, baudrate=115200) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.ser = serial.Serial(port, baudrate, timeout=0)
+        self._buf = bytearray()
+        self._readable = asyncio.Event()
+        self.loop.add_reader(self.ser.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except serial.SerialException as e:
+            logging.error(f"{self.ser.port}: {e}")
+            self.loop.remove_reader(self.ser.fileno())
+            return
+        if data:
+            self._buf += data
+            self._readable.set()
+
+    async def read(self, n, timeout):
+        """
+        Return up to n buffered bytes, waiting at most timeout seconds for
+        the first one. Returns b'' on timeout.
+        """
+        if not self._buf:
+            self._readable.clear()
+            try:
+                await asyncio.wait_for(self._readable.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                return b''
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def discard(self):
+        self._buf.clear()
+        self.ser.reset_input_buffer()
+
+    def set_baudrate(self, baudrate):
+        self.ser.baudrate = baudrate
+
+    def set_rts(self, level):
+        try:
+            self.ser.setRTS(level)
+        except (OSError, serial.SerialException) as e:
+            logging.debug(f"Unable to set RTS: {e}")
+
+    def close(self):
+        self.loop.remove_reader(self.ser.fileno())
+        self.ser.close()
+
+
+class AsyncWs63Session:
+    """
+    One flash session as awaitable steps:
+    handshake -> loaderboot YMODEM -> CMD_DOWNLOAD + YMODEM per partition -> reset.
+    Every step has its own timeout and the whole session can be cancelled;
+    the port is closed either way.
+    """
+
+    def __init__(self, port, baudrate=921600, auto_reset=False,
+                 handshake_interval=HANDSHAKE_INTERVAL, trim=False, on_event=None,
+                 retry_policy=None) -> None:
+        self.port = port
+        self.baudrate = baudrate
+        self.auto_reset = auto_reset
+        self.handshake_interval = handshake_interval
+        self.trim = trim
+        self.metrics = SessionMetrics(port)
+        # Callable or queue receiving events.Event records
+        self.events = EventEmitter(on_event, port)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.ack_timer = self.retry_policy.timer()
+        self.serial = None
+
+    @contextmanager
+    def _stage(self, stage, name=None, total=None):
+        with self.metrics.stage(stage), self.events.stage(stage, name, total):
+            yield
+
+    async def open(self):
+        self.serial = AsyncSerial(self.port)
+        self.serial.set_rts(False)
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def reset_device(self):
+        self.serial.set_rts(True)
+        await asyncio.sleep(RESET_PULSE)
+        self.serial.set_rts(False)
+
+    async def handshake(self, timeout=RESET_TIMEOUT):
+        """
+        Returns the time to handshake; raises asyncio.TimeoutError.
+        """
+        return await asyncio.wait_for(self._handshake(), timeout)
+
+    async def _handshake(self):
+        if self.auto_reset:
+            await self.reset_device()
+        frame = handshake_frame(self.baudrate)
+        tail = b""
+        t0 = time.time()
+        while True:
+            self.serial.write(frame)
+            deadline = time.time() + self.handshake_interval
+            while time.time() < deadline:
+                data = await self.serial.read(4096, deadline - time.time())
+                if not data:
+                    break
+                data = tail + data
+                if HANDSHAKE_ACK in data:
+                    return time.time() - t0
+                tail = data[-(len(HANDSHAKE_ACK) - 1):]
+
+    async def read_frame(self, timeout=UART_READ_TIMEOUT):
+        """
+        Next frame from the device; raises asyncio.TimeoutError.
+        """
+        parser = FrameParser()
+        deadline = time.time() + timeout
+        while True:
+            frame = parser.pop()
+            if frame is not None:
+                if not frame.crc_ok:
+                    logging.warning("Warning: bad CRC from frame!")
+                return frame
+            # Only take the rest of this frame, the YMODEM 'C' may follow
+            data = await self.serial.read(parser.want(), deadline - time.time())
+            if not data:
+                raise asyncio.TimeoutError("Timeout waiting for frame")
+            parser.feed(data)
+
+    async def _wait_reply(self, stats, timeout):
+        deadline = time.time() + timeout
+        while True:
+            cc = await self.serial.read(1, deadline - time.time())
+            if not cc:
+                stats.timeouts += 1
+                return None
+            if cc[0] == NAK:
+                stats.naks += 1
+            if cc[0] in (ACK, NAK, CAN):
+                return cc[0]
+
+    async def _xmit(self, blk, stats):
+        """
+        Same retry policy as pymodem.ymodem_blk_timed_xmit. Raises
+        asyncio.TimeoutError when retries run out and
+        ConnectionAbortedError on CAN or repeated NAKs.
+        """
+        policy = self.ack_timer.policy
+        naks = 0
+        for attempt in range(policy.max_retries + 1):
+            if attempt:
+                stats.retries += 1
+                self.serial.discard()
+            t_write = time.time()
+            self.serial.write(blk)
+            reply = await self._wait_reply(stats, self.ack_timer.timeout(attempt))
+            if reply == ACK:
+                if attempt == 0:
+                    self.ack_timer.sample(time.time() - t_write)
+                stats.blocks += 1
+                stats.rtts.append(time.time() - t_write)
+                return
+            if reply == CAN:
+                raise ConnectionAbortedError("Transfer cancelled by receiver")
+            naks = naks + 1 if reply == NAK else 0
+            if naks >= policy.max_naks:
+                raise ConnectionAbortedError(f"YMODEM block rejected {naks} times in a row")
+        raise asyncio.TimeoutError(f"No ACK after {policy.max_retries} retries")
+
+    async def _send_eot(self, stats):
+        for attempt in range(self.ack_timer.policy.max_retries + 1):
+            self.serial.write(bytes([EOT]))
+            reply = await self._wait_reply(stats, self.ack_timer.timeout(attempt))
+            if reply == ACK:
+                return
+            if reply == CAN:
+                raise ConnectionAbortedError("Transfer cancelled by receiver")
+        raise asyncio.TimeoutError("EOT not acknowledged")
+
+    async def send_file(self, data, file_name, stats=None):
+        """
+        YMODEM transfer of one buffer; raises asyncio.TimeoutError.
+        """
+        if stats is None:
+            stats = XferStats()
+        deadline = time.time() + YMODEM_C_TIMEOUT
+        while True:
+            cc = await self.serial.read(1, deadline - time.time())
+            if not cc:
+                raise asyncio.TimeoutError("Timeout waiting for 'C'")
+            if cc[0] == C:
+                break
+        await self._xmit(ymodem_info_blk(file_name, len(data)), stats)
+        t0 = time.time()
+        sent = 0
+        for blk in ymodem_data_blks(data):
+            await self._xmit(blk, stats)
+            sent = min(sent + 1024, len(data))
+            self.events.progress(sent, len(data), stats.retries)
+        self.events.progress(len(data), len(data), stats.retries, force=True)
+        stats.bytes += len(data)
+        stats.elapsed += time.time() - t0
+        await self._send_eot(stats)
+        await self._xmit(ymodem_info_blk(), stats)
+        return stats
+
+    async def load_loaderboot(self, fwpkg, loaderboot):
+        self.serial.set_baudrate(115200)
+        self.serial.discard()
+        with self._stage("handshake"):
+            elapsed = await self.handshake()
+        logging.info(f"{self.port}: handshake after {elapsed:.2f}s")
+        self.serial.set_baudrate(self.baudrate)
+        self.ack_timer = self.retry_policy.timer()
+        await asyncio.sleep(0.5)
+        with self._stage("loaderboot", loaderboot.name, loaderboot.length):
+            stats = await self.send_file(fwpkg.data(loaderboot), loaderboot.name)
+            await self.read_frame()
+        self.metrics.baudrate = self.baudrate
+        self.metrics.add_partition(loaderboot.name, stats)
+
+    async def download(self, fwpkg, bin_info):
+        length = fwpkg.trimmed_length(bin_info) if self.trim else bin_info.length
+        t0 = time.time()
+        with self._stage("erase", bin_info.name):
+            self.serial.write(download_frame(bin_info.burn_addr, length,
+                                             erase_size(bin_info.length)))
+            await self.read_frame()
+        erase = time.time() - t0
+        with self._stage("transfer", bin_info.name, length):
+            stats = await self.send_file(fwpkg.data(bin_info)[:length], bin_info.name)
+        self.metrics.add_partition(bin_info.name, stats, erase)
+
+    async def reset(self):
+        with self._stage("reset"):
+            self.serial.write(reset_frame())
+            await self.read_frame()
+
+    async def flash(self, fwpkg):
+        """
+        Run the whole sequence on an opened session. Returns True on
+        success; timeouts are logged and reported as failure.
+        """
+        self.metrics = SessionMetrics(self.port)
+        ok = False
+        try:
+            loaderboot = next((b for b in fwpkg.bin_infos if b.type == 0), None)
+            if loaderboot is None:
+                logging.error("Required loaderboot not found in fwpkg!")
+                return False
+            await self.load_loaderboot(fwpkg, loaderboot)
+            for bin_info in fwpkg.bin_infos:
+                if bin_info.type != 1:
+                    continue
+                logging.info(f"{self.port}: transferring {bin_info.name}...")
+                await self.download(fwpkg, bin_info)
+                await asyncio.sleep(0.1)
+            await self.reset()
+            ok = True
+            return True
+        except (asyncio.TimeoutError, ConnectionAbortedError) as e:
+            logging.error(f"{self.port}: {e or 'timeout'}")
+            return False
+        finally:
+            self.metrics.finish(ok)
+            self.events.emit(SESSION_END, None, ok=ok)
+
+
+async def flash_port(port, fwpkg, **options):
+    """
+    Flash one port and return its SessionMetrics. Errors such as a port
+    that cannot be opened or is unplugged are logged and reported as a
+    failed session, so they never cancel the other ports of flash_many.
+    """
+    session = AsyncWs63Session(port, **options)
+    try:
+        async with session:
+            await session.flash(fwpkg)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"{port}: {e}")
+    return session.metrics
+
+
+async def flash_many(ports, fwpkg, **options):
+    """
+    Flash all ports concurrently from the current event loop and return
+    their SessionMetrics in order.
+    """
+    return await asyncio.gather(*(flash_port(port, fwpkg, **options) for port in ports))
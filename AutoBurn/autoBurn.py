@@ -1,38 +1,448 @@
+import glob
+import json
 import logging
+import os
+import shlex
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import click
 
 from .ws63flash import Ws63BurnTools
-from .fwpkg import Fwpkg
+from .events import JsonLines, RichProgress, fanout
+from .pymodem import RetryPolicy
+from .fwpkg import FwpkgWriter, check_bin_name, get_console, open_fwpkg
+from .manifest import BaudCache, Manifest
+from .metrics import write_json_report, write_prometheus
+from .serialio import open_serial
+from .station import DEFAULT_PATTERNS, DEFAULT_SOCKET, FlashStation, query_status
+from .trace import ReplaySerial, TraceMismatch, read_trace, recorder, trace_summary
 
 
-@click.command()
-@click.option('--verbose', '-v', is_flag=True, default=False, help='打印一些调试信息.')
-@click.option('--port', '-p', type=str, default="", help='指定串口号.')
-@click.option('--baudrate', '-b', default=921600, type=int, help='设置串口波特率.')
-@click.option('--show', '-s', is_flag=True, default=False, help='仅展示固件信息.')
-@click.argument('firmware_file', type=click.Path(exists=True), required=True)
-def flash_firmware(verbose, port, baudrate, show, firmware_file):
+class DefaultGroup(click.Group):
     """
-    烧录ws63固件
+    第一个参数不是子命令时交给默认命令, 兼容 burn FIRMWARE_FILE 的用法
     """
-    # 配置日志
+
+    def __init__(self, *args, default=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default = default
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args.insert(0, self.default)
+        return super().parse_args(ctx, args)
+
+
+def setup_logging(verbose, stderr=False):
+    """
+    日志只在命令行入口配置, 作为库导入时不加载 rich
+    stderr 用于标准输出要写入数据的命令
+    """
+    from rich.console import Console
+    from rich.logging import RichHandler
+
+    logging.basicConfig(format="%(message)s", handlers=[RichHandler(console=Console(stderr=stderr))])
     logger = logging.getLogger()
     if verbose:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+    return logger
+
+
+def parse_baudrate(ctx, param, value):
+    if value is None or value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise click.BadParameter("must be an integer or 'auto'")
+
+
+def parse_ack_timeout(ctx, param, value):
+    """
+    FLOOR[:CEILING], 单位秒
+    """
+    if value is None:
+        return None
+    try:
+        bounds = [float(v) for v in value.split(':')]
+        if len(bounds) > 2:
+            raise ValueError("expected FLOOR[:CEILING]")
+        return RetryPolicy(*bounds)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def expand_ports(patterns):
+    """
+    展开串口参数, 支持通配符 (如 /dev/ttyUSB*)
+    """
+    ports = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            matched = sorted(glob.glob(pattern))
+            if not matched:
+                logging.warning(f"No serial port matches {pattern}")
+        else:
+            matched = [pattern]
+        for port in matched:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+
+def flash_port(port, firmware_file, fwpkg, **options):
+    tools = Ws63BurnTools(port, **options)
+    try:
+        tools.flash(firmware_file, fwpkg)
+    except Exception as e:
+        logging.error(f"{port}: {e}")
+    return tools.metrics
+
+
+def show_summary(results):
+    from rich.table import Table
+
+    table = Table(show_header=True, header_style="bold magenta")
+    table.add_column("PORT", justify="left")
+    table.add_column("RESULT", justify="center")
+    table.add_column("TIME", justify="right")
+    table.add_column("BAUD", justify="right")
+    table.add_column("RETRIES", justify="right")
+    for metrics in results:
+        summary = metrics.to_dict()
+        table.add_row(
+            metrics.port,
+            "[green]PASS" if metrics.success else "[red]FAIL",
+            f"{metrics.duration:.1f}s",
+            str(metrics.baudrate or "-"),
+            str(summary["retries"])
+        )
+    get_console().print(table)
+
+
+def load_firmware(firmware_file):
+    """
+    打开并完整校验固件, 损坏或截断的固件报告为参数错误
+    """
+    try:
+        fwpkg = open_fwpkg(firmware_file)
+    except (OSError, KeyError, ValueError) as e:
+        raise click.BadParameter(str(e), param_hint="FIRMWARE_FILE")
+    try:
+        fwpkg.verify()
+    except (OSError, ValueError) as e:
+        fwpkg.close()
+        raise click.BadParameter(str(e), param_hint="FIRMWARE_FILE")
+    return fwpkg
+
+
+def flash_ports(ports, firmware_file, jobs=0, report=None, prom=None, events=None, **options):
+    """
+    多串口并行烧录, 固件只解析一次, 所有串口共享
+    options 透传给 Ws63BurnTools, report/prom 为 JSON 报告和 Prometheus 文本文件路径,
+    events 为 JSON lines 事件输出路径
+    """
+    with load_firmware(firmware_file) as fwpkg:
+        fwpkg.show()
+        # 所有串口共用一个进度显示, 每个串口一行
+        event_file = open(events, 'w', encoding='utf-8') if events else None
+        try:
+            with RichProgress() as progress, \
+                    ThreadPoolExecutor(max_workers=jobs or len(ports)) as pool:
+                options['on_event'] = fanout(progress, event_file and JsonLines(event_file))
+                futures = [pool.submit(flash_port, port, firmware_file, fwpkg, **options)
+                           for port in ports]
+                results = [future.result() for future in futures]
+        finally:
+            if event_file:
+                event_file.close()
+    if len(ports) > 1:
+        show_summary(results)
+    if report:
+        write_json_report(report, results)
+    if prom:
+        write_prometheus(prom, results)
+    return all(metrics.success for metrics in results)
+
+
+@click.group(cls=DefaultGroup, default='flash')
+def cli():
+    """
+    WS63 烧录工具, 不指定子命令时执行 flash
+    """
+
+
+@cli.command('flash')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='打印一些调试信息.')
+@click.option('--port', '-p', type=str, multiple=True, help='指定串口号, 可重复指定或使用通配符批量烧录.')
+@click.option('--baudrate', '-b', default="921600", callback=parse_baudrate,
+              help='设置串口波特率, auto 表示自动协商可用的最高波特率.')
+@click.option('--no-baud-cache', is_flag=True, default=False, help='auto 模式下不读写波特率缓存.')
+@click.option('--jobs', '-j', default=0, type=int, help='批量烧录时的最大并行数, 默认等于串口数.')
+@click.option('--incremental', '-i', is_flag=True, default=False, help='增量烧录, 跳过设备上未变化的分区.')
+@click.option('--device-id', type=str, default=None, help='增量烧录记录使用的设备标识, 默认使用串口号.')
+@click.option('--reset', '-r', is_flag=True, default=False, help='通过 RTS 自动复位设备.')
+@click.option('--trim', '-t', is_flag=True, default=False, help='不传输分区末尾的 0xFF 填充块 (擦除范围不变).')
+@click.option('--ack-timeout', default=None, callback=parse_ack_timeout, metavar='FLOOR[:CEILING]',
+              help='YMODEM ACK 超时的下限和上限 (秒), 实际超时按测得的往返时间自适应, 默认 0.1:1.5.')
+@click.option('--resume', default=0, type=int, metavar='N',
+              help='分区传输失败时原地重试, 会话丢失时重新复位并加载 loaderboot, 最多 N 次, 已完成的分区不重传.')
+@click.option('--report', type=click.Path(dir_okay=False), default=None, help='烧录结束后写入 JSON 统计报告.')
+@click.option('--prom', type=click.Path(dir_okay=False), default=None, help='烧录结束后写入 Prometheus textfile 指标.')
+@click.option('--events', type=click.Path(dir_okay=False), default=None,
+              help='将阶段/进度事件以 JSON lines 写入该文件 (可为命名管道), 供自动化使用.')
+@click.option('--trace', type=click.Path(dir_okay=False), default=None,
+              help='将串口收发记录到二进制 trace 文件, 供 burn replay 回放; 多串口时路径中用 {port} 区分.')
+@click.option('--show', '-s', is_flag=True, default=False, help='仅展示固件信息.')
+@click.argument('firmware_file', type=str, required=True)
+def flash_firmware(verbose, port, baudrate, no_baud_cache, jobs, incremental, device_id, reset, trim, ack_timeout,
+                   resume, report, prom, events, trace, show, firmware_file):
+    """
+    烧录ws63固件
+
+    FIRMWARE_FILE 可以是 fwpkg 文件、.gz 压缩包、zip/tar 压缩包 (archive.zip:member 指定成员) 或 - (从标准输入读取)
+    """
+    # 配置日志
+    logger = setup_logging(verbose)
 
     # 烧录工具
     if show:
-        fwpkg = Fwpkg(firmware_file)
-        fwpkg.show()
+        with load_firmware(firmware_file) as fwpkg:
+            fwpkg.show()
     else:
-        if port:
-            tools = Ws63BurnTools(port, baudrate)
-            tools.flash(firmware_file)
-        else:
+        ports = expand_ports(port)
+        if not ports:
             logger.error("Please specify a serial port with -p or --port")
+        elif device_id and len(ports) > 1:
+            logger.error("--device-id can only be used with a single port")
+        elif trace and len(ports) > 1 and "{port}" not in trace:
+            logger.error("--trace needs {port} in the path when flashing several ports")
+        elif not flash_ports(ports, firmware_file, jobs, report, prom, events, baudrate=baudrate,
+                             incremental=incremental, device_id=device_id,
+                             auto_reset=reset, cache_baudrate=not no_baud_cache, trim=trim,
+                             retry_policy=ack_timeout, resume_retries=resume,
+                             transport=recorder(trace) if trace else open_serial):
+            sys.exit(1)
+
+
+@cli.command('serve')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='打印一些调试信息.')
+@click.option('--port', '-p', type=str, multiple=True,
+              help=f'监视的串口通配符, 可重复指定, 默认 {" ".join(DEFAULT_PATTERNS)}.')
+@click.option('--baudrate', '-b', default="921600", callback=parse_baudrate,
+              help='设置串口波特率, auto 表示自动协商可用的最高波特率.')
+@click.option('--workers', '-w', default=4, type=int, help='同时烧录的最大设备数.')
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False), default=DEFAULT_SOCKET,
+              help='状态查询使用的 Unix socket 路径.')
+@click.option('--include-present', is_flag=True, default=False, help='启动时已连接的串口也进行烧录.')
+@click.option('--incremental', '-i', is_flag=True, default=False,
+              help='增量烧录, 按 USB 序列号识别设备并跳过未变化的分区, 无序列号的设备完整烧录.')
+@click.option('--reset', '-r', is_flag=True, default=False, help='通过 RTS 自动复位设备.')
+@click.option('--trim', '-t', is_flag=True, default=False, help='不传输分区末尾的 0xFF 填充块 (擦除范围不变).')
+@click.option('--ack-timeout', default=None, callback=parse_ack_timeout, metavar='FLOOR[:CEILING]',
+              help='YMODEM ACK 超时的下限和上限 (秒), 默认 0.1:1.5.')
+@click.option('--resume', default=0, type=int, metavar='N', help='失败后最多重试 N 次, 已完成的分区不重传.')
+@click.argument('firmware_file', type=str, required=True)
+def serve(verbose, port, baudrate, workers, socket_path, include_present, incremental, reset, trim,
+          ack_timeout, resume, firmware_file):
+    """
+    常驻烧录站: 检测新插入的串口并自动烧录
+    """
+    setup_logging(verbose)
+    with load_firmware(firmware_file) as fwpkg:
+        fwpkg.show()
+        station = FlashStation(fwpkg, list(port), workers, socket_path, include_present,
+                               baudrate=baudrate, incremental=incremental,
+                               auto_reset=reset, trim=trim, retry_policy=ack_timeout,
+                               resume_retries=resume)
+        try:
+            station.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+@cli.command('status')
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False), default=DEFAULT_SOCKET,
+              help='烧录站的 Unix socket 路径.')
+def status(socket_path):
+    """
+    查询常驻烧录站的状态
+    """
+    try:
+        click.echo(json.dumps(query_status(socket_path), indent=2))
+    except OSError as e:
+        raise click.ClickException(f"Unable to reach station at {socket_path}: {e}")
+
+
+@cli.command('replay')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='打印一些调试信息.')
+@click.option('--baudrate', '-b', default=None, callback=parse_baudrate,
+              help='设置串口波特率, 默认使用 trace 中记录的波特率.')
+@click.option('--speed', default=1.0, type=float, help='回放速度倍数, 0 表示设备应答不等待, 默认 1.')
+@click.option('--trim', '-t', is_flag=True, default=False, help='不传输分区末尾的 0xFF 填充块 (擦除范围不变).')
+@click.option('--ack-timeout', default=None, callback=parse_ack_timeout, metavar='FLOOR[:CEILING]',
+              help='YMODEM ACK 超时的下限和上限 (秒), 默认 0.1:1.5.')
+@click.option('--resume', default=0, type=int, metavar='N', help='失败后最多重试 N 次, 已完成的分区不重传.')
+@click.option('--loose', is_flag=True, default=False, help='主机发送内容与 trace 不一致时继续回放, 只统计次数.')
+@click.option('--report', type=click.Path(dir_okay=False), default=None, help='回放结束后写入 JSON 统计报告.')
+@click.argument('trace_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('firmware_file', type=str)
+def replay(verbose, baudrate, speed, trim, ack_timeout, resume, loose, report, trace_file, firmware_file):
+    """
+    用 --trace 记录的串口会话代替设备, 回放烧录过程
+
+    烧录参数需与记录时一致, 主机发送的内容与 trace 不符时回放失败
+    """
+    setup_logging(verbose)
+    try:
+        records = read_trace(trace_file)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="TRACE_FILE")
+    summary = trace_summary(records)
+    if baudrate is None:
+        # 握手后切换到的波特率
+        baudrate = next((rate for rate in summary["baudrates"] if rate != 115200), 115200)
+    ports = []
+
+    def open_replay(port, rate, timeout):
+        ports.append(ReplaySerial(records, speed, timeout, rate, strict=not loose))
+        return ports[-1]
+
+    tools = Ws63BurnTools("replay", baudrate, trim=trim, retry_policy=ack_timeout,
+                          resume_retries=resume, cache_baudrate=False, transport=open_replay)
+    with load_firmware(firmware_file) as fwpkg, tempfile.TemporaryDirectory() as tmp:
+        # 回放不读写本机的增量烧录记录和波特率缓存
+        tools.manifest = Manifest(os.path.join(tmp, "manifest.json"))
+        tools.baud_cache = BaudCache(os.path.join(tmp, "baudrate.json"))
+        try:
+            ok = tools.flash(firmware_file, fwpkg)
+        except TraceMismatch as e:
+            logging.error(f"Replay diverged from the trace: {e}")
+            ok = None
+    if report:
+        write_json_report(report, [tools.metrics])
+    finished = all(ser.finished for ser in ports)
+    mismatches = sum(ser.mismatches for ser in ports)
+    logging.info(f"Replay {'PASS' if ok else 'FAIL'} in {tools.metrics.duration:.2f}s "
+                 f"(recorded {summary['duration']:.2f}s), {mismatches} mismatches, "
+                 f"trace {'fully' if finished else 'not fully'} consumed")
+    if ok is None or mismatches or not finished:
+        sys.exit(1)
+
+
+def parse_bin_spec(ctx, param, value):
+    """
+    NAME=FILE@ADDR[:TYPE[:BURN_SIZE]], TYPE 默认 1, loaderboot 为 0, BURN_SIZE 默认为文件长度
+    """
+    specs = []
+    for spec in value:
+        try:
+            name, rest = spec.split('=', 1)
+            path, addr = rest.rsplit('@', 1)
+            fields = [int(v, 0) for v in addr.split(':')]
+            if len(fields) > 3:
+                raise ValueError()
+            addr, type_, burn_size = fields + [1, None][len(fields) - 1:]
+            specs.append((name, path, addr, type_, burn_size))
+        except ValueError:
+            raise click.BadParameter(f"{spec}: expected NAME=FILE@ADDR[:TYPE[:BURN_SIZE]]")
+    return specs
+
+
+def write_package(writer, output):
+    try:
+        if output == '-':
+            writer.write(sys.stdout.buffer)
+        else:
+            writer.write(output)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    if not any(b.type == 0 for b in writer.bin_infos()):
+        logging.warning("Package has no loaderboot (type 0), it cannot be flashed")
+
+
+@cli.command('pack')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='打印一些调试信息.')
+@click.option('--output', '-o', type=str, required=True, help='输出的 fwpkg 文件, - 表示标准输出.')
+@click.argument('bins', nargs=-1, required=True, callback=parse_bin_spec)
+def pack(verbose, output, bins):
+    """
+    将 bin 文件打包为 fwpkg
+
+    BINS 格式为 NAME=FILE@ADDR[:TYPE[:BURN_SIZE]], 按给出的顺序存放, TYPE 默认 1, loaderboot 为 0, 例如:
+
+    burn pack -o app.fwpkg loaderboot=lb.bin@0:0 app=app.bin@0x230000
+    """
+    setup_logging(verbose, stderr=output == '-')
+    writer = FwpkgWriter()
+    try:
+        for name, path, addr, type_, burn_size in bins:
+            writer.add(name, path, addr, type_, burn_size)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    write_package(writer, output)
+
+
+@cli.command('unpack')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='打印一些调试信息.')
+@click.option('--output', '-o', type=click.Path(file_okay=False), default='.', help='输出目录.')
+@click.argument('firmware_file', type=str, required=True)
+def unpack(verbose, output, firmware_file):
+    """
+    将 fwpkg 中的各分区解出为 NAME.bin, 并打印重新打包所需的参数
+    """
+    setup_logging(verbose)
+    with load_firmware(firmware_file) as fwpkg:
+        # Names come from the package, check them all before writing anything
+        try:
+            for bin_info in fwpkg.bin_infos:
+                check_bin_name(bin_info.name)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        os.makedirs(output, exist_ok=True)
+        specs = []
+        for bin_info in fwpkg.bin_infos:
+            path = os.path.join(output, f"{bin_info.name}.bin")
+            with open(path, 'wb') as f:
+                f.write(fwpkg.data(bin_info))
+            spec = f"{bin_info.name}={path}@0x{bin_info.burn_addr:x}:{bin_info.type}"
+            if bin_info.burn_size != bin_info.length:
+                spec += f":0x{bin_info.burn_size:x}"
+            specs.append(shlex.quote(spec))
+    click.echo(' '.join(specs))
+
+
+@cli.command('subset')
+@click.option('--verbose', '-v', is_flag=True, default=False, help='打印一些调试信息.')
+@click.option('--output', '-o', type=str, required=True, help='输出的 fwpkg 文件, - 表示标准输出.')
+@click.option('--exclude', '-x', is_flag=True, default=False, help='去掉指定的分区, 而不是只保留它们.')
+@click.argument('firmware_file', type=str, required=True)
+@click.argument('names', nargs=-1, required=True)
+def subset(verbose, output, exclude, firmware_file, names):
+    """
+    从 fwpkg 中挑选分区生成精简包, loaderboot 总是保留
+
+    例如只保留 app: burn subset full.fwpkg -o slim.fwpkg app
+    """
+    setup_logging(verbose, stderr=output == '-')
+    with load_firmware(firmware_file) as fwpkg:
+        unknown = set(names) - {b.name for b in fwpkg.bin_infos}
+        if unknown:
+            raise click.BadParameter(f"no such partition: {', '.join(sorted(unknown))}",
+                                     param_hint='NAMES')
+        writer = FwpkgWriter()
+        for bin_info in fwpkg.bin_infos:
+            if bin_info.type == 0 or (bin_info.name in names) != exclude:
+                try:
+                    writer.add_from(fwpkg, bin_info)
+                except ValueError as e:
+                    raise click.ClickException(str(e))
+        write_package(writer, output)
 
 
 if __name__ == "__main__":
-    flash_firmware()
+    cli()
@@ -0,0 +1,283 @@
+"""
+Pseudo-terminal backed emulator of the WS63 ROM and loaderboot, for
+exercising Ws63BurnTools and ymodem_xfer without hardware (POSIX only).
+
+    with Ws63Emulator(erase_delay=0.05, nak_rate=0.01) as emu:
+        Ws63BurnTools(emu.port, 921600).flash("app.fwpkg")
+        print(emu.images)
+"""
+import logging
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+from . import CRC
+from .frame import CMD_ACK, CMD_DOWNLOAD, CMD_HANDSHAKE, CMD_RESET, FrameParser, build_frame
+from .pymodem import SOH, STX, EOT, ACK, NAK, CAN, C
+
+ACK_OK = b'\x5a\x00'
+
+# Interval between 'C' requests while waiting for a YMODEM sender
+C_INTERVAL = 1.0
+
+
+class EmulatorStopped(Exception):
+    pass
+
+
+class EmulatorReboot(Exception):
+    pass
+
+
+class Ws63Emulator:
+    """
+    Device side of the protocol: answers handshakes, receives YMODEM
+    transfers, and replies to CMD_DOWNLOAD/CMD_RESET frames.
+
+    latency      delay before every reply, in seconds
+    erase_delay  delay before replying to CMD_DOWNLOAD
+    boot_delay   time after start/reset before the ROM answers handshakes
+    nak_rate     probability of NAKing a good YMODEM block
+    drop_rate    probability of silently dropping a YMODEM block
+    stall_after  go silent once after this many YMODEM data blocks, for
+                 stall_time seconds; the transfer is then abandoned, or
+                 with stall_reboot the board restarts into the ROM
+    """
+
+    def __init__(self, latency=0.0, erase_delay=0.0, boot_delay=0.0,
+                 nak_rate=0.0, drop_rate=0.0, seed=None, stall_after=None,
+                 stall_time=1.0, stall_reboot=False) -> None:
+        self.latency = latency
+        self.erase_delay = erase_delay
+        self.boot_delay = boot_delay
+        self.nak_rate = nak_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.stall_after = stall_after
+        self.stall_time = stall_time
+        self.stall_reboot = stall_reboot
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        # Received files as (name, data), and CMD_DOWNLOAD requests as
+        # (burn_addr, length, erase_size)
+        self.images = []
+        self.downloads = []
+        # Flash contents per erased region: burn_addr -> bytearray
+        self.flash = {}
+        self.sessions = 0
+        self.naks = 0
+        self.drops = 0
+        self.blocks = 0
+        self.stalls = 0
+        self.cancels = 0
+
+        self._rx = bytearray()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def read_flash(self, addr, size):
+        """
+        Contents of an erased and written region, as the board would read it.
+        """
+        return bytes(self.flash[addr][:size])
+
+    # Byte level helpers
+
+    def _fill(self, timeout):
+        if self._stop.is_set():
+            raise EmulatorStopped()
+        readable, _, _ = select.select([self.master], [], [], timeout)
+        if readable:
+            self._rx += os.read(self.master, 4096)
+            return True
+        return False
+
+    def _read_exact(self, n, timeout):
+        deadline = time.time() + timeout
+        while len(self._rx) < n:
+            if not self._fill(min(0.1, max(deadline - time.time(), 0))) \
+                    and time.time() > deadline:
+                return None
+        data = bytes(self._rx[:n])
+        del self._rx[:n]
+        return data
+
+    def _write(self, data):
+        if self.latency:
+            time.sleep(self.latency)
+        os.write(self.master, data)
+
+    def _reply(self, cmd=CMD_ACK, payload=ACK_OK):
+        self._write(build_frame(cmd, payload))
+
+    def _next_frame(self, parser):
+        while True:
+            parser.feed(self._rx)
+            self._rx.clear()
+            frame = parser.pop()
+            if frame is not None:
+                return frame
+            self._fill(0.1)
+
+    # Protocol
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    self._rom()
+                    self._loaderboot()
+                except EmulatorReboot:
+                    pass
+        except EmulatorStopped:
+            pass
+        except Exception:
+            logging.exception("Emulator failed")
+
+    def _rom(self):
+        boot = time.time()
+        parser = FrameParser()
+        while True:
+            frame = self._next_frame(parser)
+            if frame.crc_ok and frame.cmd == CMD_HANDSHAKE \
+                    and time.time() - boot >= self.boot_delay:
+                break
+        self.sessions += 1
+        self._reply()
+        # The host keeps sending handshakes until it sees the ACK
+        time.sleep(0.05)
+        self._rx.clear()
+        self._ymodem_recv()
+        self._reply()
+
+    def _loaderboot(self):
+        parser = FrameParser()
+        while True:
+            frame = self._next_frame(parser)
+            if not frame.crc_ok:
+                continue
+            if frame.cmd == CMD_DOWNLOAD:
+                addr, length, erase = struct.unpack_from('<3I', frame.payload)
+                self.downloads.append((addr, length, erase))
+                if self.erase_delay:
+                    time.sleep(self.erase_delay)
+                self.flash[addr] = bytearray(b'\xff' * erase)
+                self._reply()
+                image = self._ymodem_recv()
+                if image is not None:
+                    self.flash[addr][:len(image)] = image
+            elif frame.cmd == CMD_RESET:
+                self._reply()
+                return
+            elif frame.cmd == CMD_HANDSHAKE:
+                # Handshakes only reach a loaderboot if the board was reset
+                raise EmulatorReboot()
+
+    def _recv_blk(self, timeout):
+        """
+        Return (seq, data) of the next good block, b'' for EOT, or None on
+        timeout. Bad or dropped blocks are NAKed or ignored here.
+        """
+        while True:
+            head = self._read_exact(1, timeout)
+            if head is None:
+                return None
+            if head[0] == EOT:
+                return b''
+            if head[0] == CAN:
+                self.cancels += 1
+                return None
+            if head[0] not in (SOH, STX):
+                continue
+            size = 128 if head[0] == SOH else 1024
+            rest = self._read_exact(size + 4, timeout)
+            if rest is None:
+                return None
+            seq, seq_inv = rest[0], rest[1]
+            data = rest[2:2 + size]
+            crc = struct.unpack('>H', rest[2 + size:])[0]
+            if seq ^ seq_inv != 0xff or CRC.calc_crc16(data) != crc:
+                self._write(bytes([NAK]))
+                continue
+            if head[0] == STX:
+                self.blocks += 1
+                if self.blocks == self.stall_after:
+                    self._stall()
+                    return None
+            if self.random.random() < self.drop_rate:
+                self.drops += 1
+                continue
+            if self.random.random() < self.nak_rate:
+                self.naks += 1
+                self._write(bytes([NAK]))
+                continue
+            return seq, data
+
+    def _stall(self):
+        self.stalls += 1
+        deadline = time.time() + self.stall_time
+        while time.time() < deadline:
+            self._fill(max(deadline - time.time(), 0))
+            self._rx.clear()
+        if self.stall_reboot:
+            raise EmulatorReboot()
+
+    def _ymodem_recv(self):
+        # Block 0, requested with 'C' until the sender starts
+        while True:
+            self._write(bytes([C]))
+            blk = self._recv_blk(C_INTERVAL)
+            if blk:
+                break
+        name, size = blk[1].split(b'\x00')[:2]
+        name = name.decode()
+        size = int(size.decode(), 16)
+        self._write(bytes([ACK]))
+
+        data = bytearray()
+        expect = 1
+        while True:
+            blk = self._recv_blk(10)
+            if blk is None:
+                return None
+            if blk == b'':
+                self._write(bytes([ACK]))
+                break
+            seq, payload = blk
+            if seq == expect & 0xff:
+                data += payload
+                expect += 1
+            # Duplicates after a lost ACK are acknowledged again
+            self._write(bytes([ACK]))
+
+        # Closing empty block 0
+        if self._recv_blk(10):
+            self._write(bytes([ACK]))
+        self.images.append((name, bytes(data[:size])))
+        return data[:size]
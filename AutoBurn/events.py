@@ -0,0 +1,175 @@
+"""
+Structured progress events for flash sessions.
+
+Sessions report stage boundaries and transfer progress through an
+EventEmitter, which hands Event records to a caller-supplied sink: any
+callable, or a queue (anything with put_nowait). Progress events are
+rate-limited per emitter so the YMODEM loop never waits on a consumer.
+RichProgress and JsonLines are the bundled consumers.
+"""
+import json
+import queue
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Minimum seconds between two progress events of one session
+PROGRESS_INTERVAL = 0.1
+
+STAGE_START = 'stage_start'
+PROGRESS = 'progress'
+STAGE_END = 'stage_end'
+# Last event of a session, ok is the overall result
+SESSION_END = 'session_end'
+
+# stage: handshake, loaderboot, erase, transfer, reset
+# name: partition being processed, if any
+# done/total: bytes sent / to send, None outside transfers
+Event = namedtuple(
+    'Event', ['kind', 'port', 'stage', 'name', 'done', 'total', 'retries', 'ok', 'time'])
+
+
+class EventEmitter:
+    """
+    Event source of one session. Without a sink every call returns
+    immediately.
+    """
+
+    def __init__(self, sink=None, port=None, interval=PROGRESS_INTERVAL) -> None:
+        if hasattr(sink, 'put_nowait'):
+            sink = _queue_sink(sink)
+        self.sink = sink
+        self.port = port
+        self.interval = interval
+        self._stage = None
+        self._name = None
+        self._next = 0.0
+
+    def emit(self, kind, stage, name=None, done=None, total=None, retries=0, ok=None):
+        if self.sink is not None:
+            self.sink(Event(kind, self.port, stage, name, done, total, retries, ok, time.time()))
+
+    def progress(self, done, total, retries=0, force=False):
+        """
+        Report bytes sent in the current stage. Called per block, so it
+        drops events arriving faster than interval unless forced.
+        """
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if now < self._next and not force:
+            return
+        self._next = now + self.interval
+        self.emit(PROGRESS, self._stage, self._name, done, total, retries)
+
+    def start(self, stage, name=None, total=None):
+        self._stage = stage
+        self._name = name
+        self._next = 0.0
+        self.emit(STAGE_START, stage, name, None if total is None else 0, total)
+
+    def end(self, stage, name=None, ok=True):
+        self.emit(STAGE_END, stage, name, ok=ok)
+
+    @contextmanager
+    def stage(self, stage, name=None, total=None):
+        """
+        Bracket a stage with start/end events. The stage fails if the
+        block raises or sets ok = False on the yielded outcome.
+        """
+        outcome = StageOutcome()
+        self.start(stage, name, total)
+        try:
+            yield outcome
+        except BaseException:
+            outcome.ok = False
+            raise
+        finally:
+            self.end(stage, name, outcome.ok)
+
+
+class StageOutcome:
+    __slots__ = ('ok',)
+
+    def __init__(self) -> None:
+        self.ok = True
+
+
+def _queue_sink(q):
+    def put(event):
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            # A slow consumer loses progress, never stalls the transfer
+            pass
+    return put
+
+
+def fanout(*sinks):
+    """
+    Deliver every event to several sinks.
+    """
+    sinks = [s for s in sinks if s is not None]
+
+    def deliver(event):
+        for sink in sinks:
+            sink(event)
+    return deliver
+
+
+class JsonLines:
+    """
+    Write events as JSON lines, for automation and log collection.
+    """
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event._asdict()) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class RichProgress:
+    """
+    Render events as rich progress bars, one row per port, so concurrent
+    sessions share one display. Use as a context manager.
+    """
+
+    def __init__(self) -> None:
+        from rich.progress import Progress
+
+        self.progress = Progress()
+        self.tasks = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            task = self.tasks.get(event.port)
+            if task is None:
+                task = self.tasks[event.port] = self.progress.add_task(str(event.port), total=None)
+        if event.kind == STAGE_START:
+            label = f"{event.port} {event.stage}" + (f" {event.name}" if event.name else "")
+            self.progress.reset(task, description=label, total=event.total)
+        elif event.kind == PROGRESS:
+            self.progress.update(task, completed=event.done, total=event.total)
+        elif event.kind == SESSION_END:
+            self.progress.update(task, description=f"{event.port} {'PASS' if event.ok else 'FAIL'}",
+                                 total=1, completed=int(bool(event.ok)))
+
+    def start(self):
+        self.progress.start()
+
+    def stop(self):
+        self.progress.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,156 @@
+import struct
+from collections import namedtuple
+from functools import lru_cache
+from . import CRC
+
+# Frame layout: magic(4) length(2) cmd(1) ~cmd(1) payload crc16(2)
+FRAME_MAGIC = b'\xef\xbe\xad\xde'
+FRAME_HEADER_SIZE = 8
+FRAME_MIN_SIZE = FRAME_HEADER_SIZE + 2
+FRAME_MAX_SIZE = 1024 + 12
+
+# Command codes
+CMD_HANDSHAKE = 0xf0
+CMD_DOWNLOAD = 0xd2
+CMD_RESET = 0x87
+CMD_ACK = 0xe1
+
+# Handshake line settings after the baud rate: data bits, stop bits,
+# parity, flow control
+UART_8N1 = b'\x08\x01\x00\x00'
+# Trailer of CMD_DOWNLOAD after addr, length and erase size
+DOWNLOAD_TRAILER = b'\x00\xff'
+# Flash is erased in blocks of this size
+ERASE_BLOCK = 0x2000
+
+
+class Frame(namedtuple('Frame', ['cmd', 'payload', 'crc_ok'])):
+    __slots__ = ()
+
+    @property
+    def status(self):
+        return self.payload[0] if self.payload else None
+
+
+class FrameParser:
+    """
+    Incremental parser for frames sent by the ROM/loaderboot. Bytes are
+    fed in bulk, frames are located with bytes.find on the magic and popped
+    once complete. want() never asks for more than the rest of the current
+    frame, so a caller reading exactly that many bytes never consumes data
+    meant for someone else (e.g. the YMODEM 'C' that follows a reply).
+    """
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+    def want(self):
+        if len(self.buf) < 6:
+            return 6 - len(self.buf)
+        framelen = struct.unpack_from('<H', self.buf, 4)[0]
+        return max(framelen - len(self.buf), 1)
+
+    def _resync(self):
+        # Drop everything before the next magic, keeping a partial magic tail
+        start = self.buf.find(FRAME_MAGIC)
+        if start >= 0:
+            del self.buf[:start]
+            return True
+        for keep in range(len(FRAME_MAGIC) - 1, 0, -1):
+            if self.buf.endswith(FRAME_MAGIC[:keep]):
+                break
+        else:
+            keep = 0
+        del self.buf[:len(self.buf) - keep]
+        return False
+
+    def pop(self):
+        """
+        Return the next complete Frame, or None if more data is needed.
+        """
+        while self._resync():
+            if len(self.buf) < 6:
+                return None
+            framelen = struct.unpack_from('<H', self.buf, 4)[0]
+            if not FRAME_MIN_SIZE <= framelen <= FRAME_MAX_SIZE:
+                # Magic inside garbage, look for the next one
+                del self.buf[:1]
+                continue
+            if len(self.buf) < framelen:
+                return None
+            raw = bytes(self.buf[:framelen])
+            del self.buf[:framelen]
+            crc_received = struct.unpack_from('<H', raw, framelen - 2)[0]
+            crc_ok = crc_received == CRC.calc_crc16(raw[:framelen - 2])
+            return Frame(raw[6], raw[FRAME_HEADER_SIZE:framelen - 2], crc_ok)
+        return None
+
+
+def hexdump(data):
+    return ' '.join(f'{x:02x}' for x in data)
+
+
+class FrameTemplate:
+    """
+    Precomputed header and header CRC of one command with a fixed payload
+    size; building a frame only runs the CRC over the payload. Immutable,
+    so templates are shared by all sessions.
+    """
+    __slots__ = ('cmd', 'payload_size', 'header', 'crc')
+
+    def __init__(self, cmd, payload_size) -> None:
+        self.cmd = cmd
+        self.payload_size = payload_size
+        self.header = FRAME_MAGIC + struct.pack(
+            '<HBB', FRAME_MIN_SIZE + payload_size, cmd, cmd ^ 0xff)
+        self.crc = CRC.calc_crc16(self.header)
+
+    def build(self, payload):
+        if len(payload) != self.payload_size:
+            raise ValueError(f"cmd 0x{self.cmd:02x} takes {self.payload_size} payload bytes")
+        crc = CRC.calc_crc16(payload, self.crc)
+        return b''.join((self.header, payload, crc.to_bytes(2, 'little')))
+
+
+HANDSHAKE_TEMPLATE = FrameTemplate(CMD_HANDSHAKE, 8)
+DOWNLOAD_TEMPLATE = FrameTemplate(CMD_DOWNLOAD, 14)
+RESET_TEMPLATE = FrameTemplate(CMD_RESET, 2)
+RESET_FRAME = RESET_TEMPLATE.build(b'\x00\x00')
+
+
+@lru_cache(maxsize=None)
+def handshake_frame(baudrate):
+    """
+    Ask the ROM to switch to baudrate, 8N1. Cached, as it is resent every
+    few milliseconds until the device answers.
+    """
+    return HANDSHAKE_TEMPLATE.build(struct.pack('<I', baudrate) + UART_8N1)
+
+
+def erase_size(length):
+    return -(-length // ERASE_BLOCK) * ERASE_BLOCK
+
+
+def download_frame(burn_addr, length, erase):
+    """
+    Erase erase bytes at burn_addr, then receive length bytes over YMODEM.
+    """
+    return DOWNLOAD_TEMPLATE.build(struct.pack('<3I', burn_addr, length, erase) + DOWNLOAD_TRAILER)
+
+
+def reset_frame():
+    return RESET_FRAME
+
+
+def build_frame(cmd, payload=b''):
+    framelen = FRAME_MIN_SIZE + len(payload)
+    buf = bytearray(framelen)
+    buf[0:4] = FRAME_MAGIC
+    struct.pack_into('<HBB', buf, 4, framelen, cmd, cmd ^ 0xff)
+    buf[FRAME_HEADER_SIZE:framelen - 2] = payload
+    crc = CRC.calc_crc16(memoryview(buf)[:framelen - 2])
+    struct.pack_into('<H', buf, framelen - 2, crc)
+    return bytes(buf)
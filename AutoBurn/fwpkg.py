@@ -1,23 +1,78 @@
+import mmap
+import os
 import struct
+import sys
+from collections import namedtuple
 from . import CRC
-from rich.table import Table
-from rich.console import Console
+from .manifest import FwpkgIndex, partition_hash
 
-console = Console()
+_console = None
+
+
+def get_console():
+    # rich is only loaded once something is actually printed
+    global _console
+    if _console is None:
+        from rich.console import Console
+        _console = Console()
+    return _console
+
+
+# Erased flash reads back as 0xFF
+ERASED_BLOCK = b'\xff' * 1024
+
+BinInfo = namedtuple(
+    'BinInfo', ['name', 'offset', 'length', 'burn_addr', 'burn_size', 'type'])
 
 
 class Fwpkg:
     MAX_PARTITION_CNT = 16
+    HEADER_SIZE = 12
+    # size of the struct (name[32], 5 uint32_t fields)
+    BIN_INFO_SIZE = 32 + 5 * 4
+
+    def __init__(self, source, name=None) -> None:
+        """
+        source is a file path, an in-memory buffer (bytes, bytearray,
+        memoryview) or a binary file object. Files on disk are memory-mapped,
+        everything else is read into memory once.
+        """
+        self._mmap = None
+        # Only packages backed by a path on disk can use the verify index
+        self.path = None
+        self.mtime_ns = None
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.buf = memoryview(source).cast('B')
+        elif hasattr(source, "read"):
+            self.buf = memoryview(source.read())
+        else:
+            self.path = os.fspath(source)
+            with open(self.path, "rb") as f:
+                st = os.fstat(f.fileno())
+                self.mtime_ns = st.st_mtime_ns
+                if st.st_size < self.HEADER_SIZE:
+                    raise ValueError("Error reading fwpkg header")
+                # Map the package once, partitions are served as views into it
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buf = memoryview(self._mmap)
+        self.name = name or self.path or "<memory>"
+        self.size = len(self.buf)
+        # SHA-256 of each partition, filled by verify()
+        self.digests = None
+        try:
+            self._parse_header()
+        except Exception:
+            # Rejected packages must not keep the mapping alive
+            self.close()
+            raise
 
-    def __init__(self, name) -> None:
-        f = open(name, "rb")
-        header_data = f.read(12)
-        if len(header_data) < 12:
+    def _parse_header(self):
+        if self.size < self.HEADER_SIZE:
             raise ValueError("Error reading fwpkg header")
 
         # Unpack header
-        self.mgc, self.crc, self.cnt, self.length = struct.unpack(
-            '<IHHI', header_data)
+        self.mgc, self.crc, self.cnt, self.length = struct.unpack_from(
+            '<IHHI', self.buf, 0)
 
         # Validate magic number
         if self.mgc != 0xefbeaddf:
@@ -27,31 +82,95 @@ class Fwpkg:
         if self.cnt > self.MAX_PARTITION_CNT:
             raise ValueError("Bin count exceeds maximum partition count")
 
-        self.bin_infos = []
-        # size of the struct (name[32], 5 uint32_t fields)
-        bin_info_size = 32 + 5 * 4
-
-        for _ in range(self.cnt):
-            bin_data = f.read(bin_info_size)
-            if len(bin_data) < bin_info_size:
-                raise ValueError("Error reading fwpkg bin info")
+        table_end = self.HEADER_SIZE + self.cnt * self.BIN_INFO_SIZE
+        if len(self.buf) < table_end:
+            raise ValueError("Error reading fwpkg bin info")
 
+        self.bin_infos = []
+        for i in range(self.cnt):
+            pos = self.HEADER_SIZE + i * self.BIN_INFO_SIZE
             # Unpack bin info
-            name = struct.unpack('32s', bin_data[:32])[
+            name = struct.unpack_from('32s', self.buf, pos)[
                 0].decode('utf-8').strip('\x00')
-            offset, length, burn_addr, burn_size, type_ = struct.unpack(
-                '<5I', bin_data[32:])
-            self.bin_infos.append({"name": name, "offset": offset, "length": length,
-                                  "burn_addr": burn_addr, "burn_size": burn_size, "type": type_})
-        f.seek(0)
-        buf = f.read(12 + self.cnt * (32 + 5 * 4))
-        crc_check = CRC.calc_crc16(buf[6:])  # Compute CRC from 6th byte onward
+            offset, length, burn_addr, burn_size, type_ = struct.unpack_from(
+                '<5I', self.buf, pos + 32)
+            self.bin_infos.append(
+                BinInfo(name, offset, length, burn_addr, burn_size, type_))
+
+        # Compute CRC from 6th byte onward
+        crc_check = CRC.calc_crc16(self.buf[6:table_end])
 
         if crc_check != self.crc:
             raise ValueError("Bad fwpkg file, CRC mismatch")
-        f.close()
+
+        self.table_end = table_end
+
+    def verify(self, use_index=True):
+        """
+        Check that every partition lies inside the file and hash its
+        payload. Results are cached in FwpkgIndex, so a package that was
+        verified before (same path, size, mtime and header CRC) only pays
+        for the bounds check.
+        """
+        for bin_info in self.bin_infos:
+            if bin_info.offset < self.table_end or \
+                    bin_info.offset + bin_info.length > self.size:
+                raise ValueError(
+                    f"Bad fwpkg file, {bin_info.name} is outside the file")
+        index = FwpkgIndex() if use_index and self.path else None
+        digests = index.get(self) if index else None
+        if digests is None or len(digests) != len(self.bin_infos):
+            digests = [partition_hash(self.data(b)) for b in self.bin_infos]
+            if index:
+                index.set(self, digests)
+        self.digests = digests
+        return digests
+
+    def trimmed_length(self, bin_info, blk_size=len(ERASED_BLOCK)):
+        """
+        Length of a partition without its trailing erased (0xFF) blocks.
+        Trimming works on blk_size boundaries from the partition start, so
+        the shortened transfer still consists of whole YMODEM blocks. At
+        least one block is kept.
+        """
+        data = self.data(bin_info)
+        end = len(data)
+        start = (end - 1) // blk_size * blk_size
+        while start > 0 and data[start:end] == ERASED_BLOCK[:end - start]:
+            end = start
+            start -= blk_size
+        return end
+
+    def digest(self, bin_info):
+        if self.digests is not None:
+            return self.digests[self.bin_infos.index(bin_info)]
+        return partition_hash(self.data(bin_info))
+
+    def data(self, bin_info):
+        """
+        Zero-copy view of a partition's payload.
+        """
+        return self.buf[bin_info.offset:bin_info.offset + bin_info.length]
+
+    def close(self):
+        self.buf.release()
+        if self._mmap is None:
+            return
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Partition views are still alive, the map goes away with them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def show(self):
+        from rich.table import Table
+
         table = Table(show_header=True, header_style="bold magenta")
         table.add_column("F", justify="center")
         table.add_column("BIN NAME", justify="left")
@@ -61,18 +180,195 @@ class Fwpkg:
         table.add_column("BURN SIZE", justify="right")
         table.add_column("T", justify="center")
         for bin_info in self.bin_infos:
-            flash_flag = '!' if bin_info['type'] == 0 else '*'
+            flash_flag = '!' if bin_info.type == 0 else '*'
             table.add_row(
                 flash_flag,
-                bin_info['name'],
-                f"0x{bin_info['offset']:08x}",
-                f"0x{bin_info['length']:08x}",
-                f"0x{bin_info['burn_addr']:08x}",
-                f"0x{bin_info['burn_size']:08x}",
-                str(bin_info['type'])
+                bin_info.name,
+                f"0x{bin_info.offset:08x}",
+                f"0x{bin_info.length:08x}",
+                f"0x{bin_info.burn_addr:08x}",
+                f"0x{bin_info.burn_size:08x}",
+                str(bin_info.type)
             )
 
-        console.print(table)
+        get_console().print(table)
+
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+def _pick_member(archive, names, member):
+    if member:
+        if member not in names:
+            raise ValueError(f"{member} not found in {archive}")
+        return member
+    candidates = [n for n in names if n.lower().endswith('.fwpkg')]
+    if len(candidates) != 1:
+        raise ValueError(f"{archive} contains {len(candidates)} .fwpkg files, "
+                         f"use {archive}:<member> to pick one")
+    return candidates[0]
+
+
+def _read_archive(archive, member):
+    import tarfile
+    import zipfile
+
+    try:
+        if archive.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive) as zf:
+                member = _pick_member(archive, zf.namelist(), member)
+                return member, zf.read(member)
+        with tarfile.open(archive) as tf:
+            names = [m.name for m in tf.getmembers() if m.isfile()]
+            member = _pick_member(archive, names, member)
+            return member, tf.extractfile(member).read()
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        # Truncated compressed streams end in EOFError
+        raise ValueError(f"Bad archive {archive}: {e}")
+
+
+def open_fwpkg(spec):
+    """
+    Open a package from a command line spec:
+      pkg.fwpkg                  file on disk (memory-mapped)
+      -                          read from stdin
+      pkg.fwpkg.gz               gzip compressed package
+      bundle.zip[:member]        zip/tar(.gz/.bz2/.xz) member, the only
+                                 .fwpkg in the archive if member is omitted
+    Compressed sources are decompressed once into memory.
+    """
+    if spec == '-':
+        return Fwpkg(sys.stdin.buffer.read(), "<stdin>")
+    archive, member = spec, None
+    if not os.path.isfile(spec) and ':' in spec:
+        archive, member = spec.rsplit(':', 1)
+    lower = archive.lower()
+    if lower.endswith(ARCHIVE_SUFFIXES):
+        member, data = _read_archive(archive, member)
+        return Fwpkg(data, f"{archive}:{member}")
+    if lower.endswith('.gz'):
+        import gzip
+
+        try:
+            with gzip.open(archive, 'rb') as f:
+                return Fwpkg(f, archive)
+        except EOFError as e:
+            raise ValueError(f"Bad gzip file {archive}: {e}")
+    return Fwpkg(spec)
+
+
+# Copy granularity when streaming partitions from files
+COPY_CHUNK = 1024 * 1024
+
+
+def check_bin_name(name):
+    """
+    Bin names become file names on unpack: reject anything that is not a
+    plain file name.
+    """
+    separators = {'/', '\\', '\x00', os.sep, os.altsep} - {None}
+    if name in ('', '.', '..') or any(c in name for c in separators):
+        raise ValueError(f"Bad bin name {name!r}, it must be a plain file name")
+
+
+class FwpkgWriter:
+    """
+    Build a package from partitions held in files or buffers. Sizes are
+    known up front, so the header is written first and partitions are
+    streamed after it: files are copied in chunks and buffers (such as
+    Fwpkg.data() views) are written without copying.
+    """
+
+    def __init__(self) -> None:
+        # (BinInfo without offset, source)
+        self.entries = []
+
+    def add(self, name, source, burn_addr, type_=1, burn_size=None):
+        """
+        source is a file path or a buffer. burn_size defaults to the
+        partition length.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            length = len(source)
+        else:
+            source = os.fspath(source)
+            length = os.path.getsize(source)
+        if len(self.entries) >= Fwpkg.MAX_PARTITION_CNT:
+            raise ValueError("Bin count exceeds maximum partition count")
+        check_bin_name(name)
+        if len(name.encode('utf-8')) > 32:
+            raise ValueError(f"Bin name {name} is longer than 32 bytes")
+        if any(e.name == name for e, _ in self.entries):
+            raise ValueError(f"Duplicate bin name {name}")
+        if burn_size is None:
+            burn_size = length
+        for value in (burn_addr, burn_size, type_):
+            if not 0 <= value <= 0xffffffff:
+                raise ValueError(f"{name}: {value} does not fit in 32 bits")
+        self.entries.append((BinInfo(name, None, length, burn_addr, burn_size, type_), source))
+
+    def add_from(self, fwpkg, bin_info):
+        self.add(bin_info.name, fwpkg.data(bin_info), bin_info.burn_addr,
+                 bin_info.type, bin_info.burn_size)
+
+    def bin_infos(self):
+        offset = Fwpkg.HEADER_SIZE + len(self.entries) * Fwpkg.BIN_INFO_SIZE
+        infos = []
+        for entry, _ in self.entries:
+            infos.append(entry._replace(offset=offset))
+            offset += entry.length
+        return infos
+
+    def header(self):
+        infos = self.bin_infos()
+        total = Fwpkg.HEADER_SIZE + len(infos) * Fwpkg.BIN_INFO_SIZE + \
+            sum(b.length for b in infos)
+        body = bytearray(struct.pack('<HI', len(infos), total))
+        for b in infos:
+            body += struct.pack('<32s5I', b.name.encode('utf-8'), b.offset, b.length,
+                                b.burn_addr, b.burn_size, b.type)
+        # The CRC covers everything after itself, as Fwpkg checks it
+        return struct.pack('<IH', 0xefbeaddf, CRC.calc_crc16(body)) + body
+
+    def write(self, dest):
+        """
+        Write to a path (replaced atomically) or a binary file object.
+        Returns the number of bytes written.
+        """
+        if hasattr(dest, "write"):
+            return self._write_to(dest)
+        dest = os.fspath(dest)
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                size = self._write_to(f)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return size
+
+    def _write_to(self, f):
+        header = self.header()
+        f.write(header)
+        size = len(header)
+        for entry, source in self.entries:
+            if isinstance(source, str):
+                with open(source, "rb") as src:
+                    copied = 0
+                    while True:
+                        chunk = src.read(COPY_CHUNK)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        copied += len(chunk)
+                if copied != entry.length:
+                    raise ValueError(f"{source} changed size while packing")
+            else:
+                f.write(source)
+            size += entry.length
+        return size
 
 
 if __name__ == "__main__":
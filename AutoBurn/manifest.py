@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def cache_dir():
+    base = os.environ.get("AUTOBURN_CACHE_DIR")
+    if base:
+        return base
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "autoburn")
+
+
+def load_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temp file first so a crash never leaves a torn file
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def partition_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def partition_record(bin_info, digest):
+    return {"burn_addr": bin_info.burn_addr, "length": bin_info.length, "sha256": digest}
+
+
+class Manifest:
+    """
+    Per-device record of the partitions written by the last successful
+    flash, used to skip unchanged partitions on the next run.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path=None) -> None:
+        self.path = path or os.path.join(cache_dir(), "manifest.json")
+
+    def get(self, device):
+        with self._lock:
+            return load_json(self.path).get(device, {})
+
+    def forget(self, device, name=None):
+        """
+        Drop the records of a device, or of one of its partitions.
+        """
+        with self._lock:
+            devices = load_json(self.path)
+            if name is None:
+                changed = devices.pop(device, None) is not None
+            else:
+                changed = devices.get(device, {}).pop(name, None) is not None
+            if changed:
+                save_json(self.path, devices)
+
+    def record(self, device, name, record):
+        # Checkpoint a single partition as soon as it is written
+        with self._lock:
+            devices = load_json(self.path)
+            devices.setdefault(device, {})[name] = record
+            save_json(self.path, devices)
+
+    def update(self, device, partitions):
+        with self._lock:
+            devices = load_json(self.path)
+            devices[device] = partitions
+            save_json(self.path, devices)
+
+
+class BaudCache:
+    """
+    Fastest baud rate that transferred the loaderboot reliably, per port.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path=None) -> None:
+        self.path = path or os.path.join(cache_dir(), "baudrate.json")
+
+    def get(self, port):
+        with self._lock:
+            return load_json(self.path).get(port, {}).get("baudrate")
+
+    def set(self, port, baudrate, throughput):
+        with self._lock:
+            ports = load_json(self.path)
+            ports[port] = {"baudrate": baudrate, "throughput": round(throughput)}
+            save_json(self.path, ports)
+
+
+class FwpkgIndex:
+    """
+    Partition hashes of fully verified packages, keyed by absolute path and
+    valid while size, mtime and header CRC are unchanged.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path=None) -> None:
+        self.path = path or os.path.join(cache_dir(), "fwpkg_index.json")
+
+    @staticmethod
+    def _key(fwpkg):
+        return {"size": fwpkg.size, "mtime_ns": fwpkg.mtime_ns, "crc": fwpkg.crc}
+
+    def get(self, fwpkg):
+        with self._lock:
+            entry = load_json(self.path).get(os.path.abspath(fwpkg.path))
+        if not entry or entry.get("key") != self._key(fwpkg):
+            return None
+        return entry.get("digests")
+
+    def set(self, fwpkg, digests):
+        with self._lock:
+            packages = load_json(self.path)
+            packages[os.path.abspath(fwpkg.path)] = {
+                "key": self._key(fwpkg), "digests": digests}
+            save_json(self.path, packages)
@@ -0,0 +1,166 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def rtt_summary(samples):
+    if not samples:
+        return {}
+    return {
+        "count": len(samples),
+        "min": min(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 0.5),
+        "p90": percentile(samples, 0.9),
+        "p99": percentile(samples, 0.99),
+        "max": max(samples),
+    }
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+class SessionMetrics:
+    """
+    Timings and YMODEM counters collected during one flash session.
+    """
+
+    def __init__(self, port) -> None:
+        self.port = port
+        self.started = time.time()
+        self.duration = 0.0
+        self.success = False
+        self.baudrate = None
+        # stage name -> accumulated seconds
+        self.stages = {}
+        self.partitions = []
+        self.rtts = []
+        # Partitions retried in place, and loaderboot reloads after a lost session
+        self.resumes = 0
+        self.reloads = 0
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.time() - t0
+
+    def add_partition(self, name, stats, erase=0.0):
+        self.rtts.extend(stats.rtts)
+        self.partitions.append({
+            "name": name,
+            "bytes": stats.bytes,
+            "seconds": stats.elapsed,
+            "bytes_per_sec": stats.throughput,
+            "erase_seconds": erase,
+            "blocks": stats.blocks,
+            "retries": stats.retries,
+            "naks": stats.naks,
+            "timeouts": stats.timeouts,
+        })
+
+    def finish(self, success):
+        self.success = success
+        self.duration = time.time() - self.started
+
+    def to_dict(self):
+        return {
+            "port": self.port,
+            "started": self.started,
+            "duration": self.duration,
+            "success": self.success,
+            "baudrate": self.baudrate,
+            "stages": self.stages,
+            "partitions": self.partitions,
+            "retries": sum(p["retries"] for p in self.partitions),
+            "naks": sum(p["naks"] for p in self.partitions),
+            "resumes": self.resumes,
+            "reloads": self.reloads,
+            "ack_rtt": rtt_summary(self.rtts),
+        }
+
+    def prometheus_lines(self):
+        port = _label(self.port)
+        lines = [
+            f'autoburn_flash_success{{port="{port}"}} {int(self.success)}',
+            f'autoburn_flash_duration_seconds{{port="{port}"}} {self.duration:.6f}',
+        ]
+        for name, seconds in self.stages.items():
+            lines.append(
+                f'autoburn_stage_duration_seconds{{port="{port}",stage="{name}"}} {seconds:.6f}')
+        for p in self.partitions:
+            lines.append(
+                f'autoburn_partition_bytes_per_second{{port="{port}",partition="{_label(p["name"])}"}} '
+                f'{p["bytes_per_sec"]:.1f}')
+        lines.append(
+            f'autoburn_ymodem_retransmits{{port="{port}"}} '
+            f'{sum(p["retries"] for p in self.partitions)}')
+        lines.append(
+            f'autoburn_ymodem_naks{{port="{port}"}} '
+            f'{sum(p["naks"] for p in self.partitions)}')
+        lines.append(f'autoburn_resumes{{port="{port}"}} {self.resumes}')
+        lines.append(f'autoburn_reloads{{port="{port}"}} {self.reloads}')
+        for q in (0.5, 0.9, 0.99):
+            lines.append(
+                f'autoburn_ack_rtt_seconds{{port="{port}",quantile="{q}"}} '
+                f'{percentile(self.rtts, q):.6f}')
+        lines.append(f'autoburn_ack_rtt_seconds_sum{{port="{port}"}} {sum(self.rtts):.6f}')
+        lines.append(f'autoburn_ack_rtt_seconds_count{{port="{port}"}} {len(self.rtts)}')
+        return lines
+
+
+METRIC_HELP = [
+    "# TYPE autoburn_flash_success gauge",
+    "# TYPE autoburn_flash_duration_seconds gauge",
+    "# TYPE autoburn_stage_duration_seconds gauge",
+    "# TYPE autoburn_partition_bytes_per_second gauge",
+    "# TYPE autoburn_ymodem_retransmits gauge",
+    "# TYPE autoburn_ymodem_naks gauge",
+    "# TYPE autoburn_resumes gauge",
+    "# TYPE autoburn_reloads gauge",
+    "# TYPE autoburn_ack_rtt_seconds summary",
+]
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write_json_report(path, sessions):
+    _write_atomic(path, json.dumps([m.to_dict() for m in sessions], indent=2) + "\n")
+
+
+def _family(name):
+    # A summary's _sum and _count samples belong to its family
+    for suffix in ("_sum", "_count"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def write_prometheus(path, sessions):
+    # Samples are grouped by metric family as the text format expects
+    lines = {}
+    for m in sessions:
+        for line in m.prometheus_lines():
+            lines.setdefault(_family(line.split("{", 1)[0]), []).append(line)
+    text = []
+    for help_line in METRIC_HELP:
+        name = help_line.split()[2]
+        text.append(help_line)
+        text.extend(lines.get(name, []))
+    _write_atomic(path, "\n".join(text) + "\n")
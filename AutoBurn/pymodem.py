@@ -1,12 +1,24 @@
 import time
+import queue
 import struct
+import threading
+from collections import namedtuple
 from . import CRC
 import logging
-from rich.progress import Progress
+from .events import EventEmitter
+from .serialio import wait_readable
 
 YMODEM_C_TIMEOUT = 5
+# Bounds of the adaptive ACK timeout. Until the first ACK is timed the
+# ceiling is used, afterwards srtt + 4 * rttvar as in RFC 6298.
+YMODEM_ACK_FLOOR = 0.1
 YMODEM_ACK_TIMEOUT = 1.5
-YMODEM_XMIT_TIMEOUT = 30
+# Resends of one block (timeout doubling each time) before giving up
+YMODEM_MAX_RETRIES = 6
+# Consecutive NAKs of one block that mark the link as broken
+YMODEM_MAX_NAKS = 3
+# Number of data blocks prepared ahead of the sender in pipelined mode
+YMODEM_PIPELINE_DEPTH = 32
 
 # Control Characters
 SOH = 0x01
@@ -14,100 +26,335 @@ STX = 0x02
 EOT = 0x04
 ACK = 0x06
 NAK = 0x15
+CAN = 0x18
 C = ord('C')
 
 
-def ymodem_wait_ack(serial_port):
+class XferStats:
+    """
+    Counters for one YMODEM transfer.
+    """
+
+    def __init__(self, max_retries=None) -> None:
+        # Give up once this many blocks had to be resent (None: no limit)
+        self.max_retries = max_retries
+        self.bytes = 0
+        self.blocks = 0
+        self.retries = 0
+        self.naks = 0
+        self.timeouts = 0
+        # Why the transfer failed, None on success
+        self.error = None
+        self.elapsed = 0.0
+        # Write-to-ACK round trip of each acknowledged block, in seconds
+        self.rtts = []
+
+    @property
+    def throughput(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def retry_rate(self):
+        return self.retries / self.blocks if self.blocks else 0.0
+
+
+class RetryPolicy(namedtuple('RetryPolicy', ['ack_floor', 'ack_ceiling', 'max_retries', 'max_naks'])):
+    """
+    ACK timeout bounds and retry limits. Immutable, so one policy can be
+    shared by concurrent sessions; each session times ACKs with its own
+    AckTimer.
+    """
+    __slots__ = ()
+
+    def __new__(cls, ack_floor=YMODEM_ACK_FLOOR, ack_ceiling=YMODEM_ACK_TIMEOUT,
+                max_retries=YMODEM_MAX_RETRIES, max_naks=YMODEM_MAX_NAKS):
+        if not 0 < ack_floor <= ack_ceiling:
+            raise ValueError("ACK timeout floor must be positive and not above the ceiling")
+        return super().__new__(cls, ack_floor, ack_ceiling, max_retries, max_naks)
+
+    def timer(self):
+        return AckTimer(self)
+
+
+class AckTimer:
+    """
+    Smoothed ACK round trip of one session and the timeouts derived
+    from it.
+    """
+
+    def __init__(self, policy=None) -> None:
+        self.policy = policy or RetryPolicy()
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    @property
+    def rto(self):
+        if self.srtt is None:
+            return self.policy.ack_ceiling
+        return min(max(self.srtt + 4 * self.rttvar, self.policy.ack_floor),
+                   self.policy.ack_ceiling)
+
+    def timeout(self, attempt=0):
+        # Exponential backoff for resends of the same block
+        return min(self.rto * (2 ** attempt), self.policy.ack_ceiling)
+
+
+def ymodem_wait_reply(serial_port, timeout, stats=None):
+    """
+    Wait for ACK, NAK or CAN. Returns the control byte, or None on
+    timeout.
+    """
     t0 = time.time()
     while True:
-        if time.time() - t0 > YMODEM_ACK_TIMEOUT:
-            return False  # Timeout
-        if serial_port.in_waiting > 0:
+        remaining = timeout - (time.time() - t0)
+        if remaining <= 0:
+            if stats is not None:
+                stats.timeouts += 1
+            return None
+        if wait_readable(serial_port, remaining):
             cc = serial_port.read(1)
-            # time.sleep(0.01)
-            if cc == bytes([ACK]):
-                return True
-            if cc == bytes([NAK]):
-                return False
+            if not cc or cc[0] not in (ACK, NAK, CAN):
+                continue
+            if cc[0] == NAK and stats is not None:
+                stats.naks += 1
+            return cc[0]
 
 
-def ymodem_blk_timed_xmit(serial_port, blk):
-    t0 = time.time()
-    while time.time() - t0 < YMODEM_XMIT_TIMEOUT:
+def ymodem_wait_ack(serial_port, stats=None, timeout=YMODEM_ACK_TIMEOUT):
+    return ymodem_wait_reply(serial_port, timeout, stats) == ACK
+
+
+def _fail(stats, error):
+    logging.warning(f"YMODEM: {error}")
+    if stats is not None:
+        stats.error = error
+    return False
+
+
+def ymodem_blk_timed_xmit(serial_port, blk, stats=None, timer=None):
+    """
+    Send one block until it is ACKed. Gives up after policy.max_retries
+    resends, policy.max_naks NAKs in a row, or when the receiver
+    cancels.
+    """
+    if timer is None:
+        timer = AckTimer()
+    policy = timer.policy
+    naks = 0
+    for attempt in range(policy.max_retries + 1):
+        if attempt:
+            if stats is not None:
+                stats.retries += 1
+                if stats.max_retries is not None and stats.retries > stats.max_retries:
+                    return _fail(stats, "too many retransmissions")
+            # Do not mistake a late ACK of the previous attempt for this one
+            if hasattr(serial_port, "reset_input_buffer"):
+                serial_port.reset_input_buffer()
+        t_write = time.time()
         serial_port.write(blk)
-        ret = ymodem_wait_ack(serial_port)
-        if ret is True:
+        reply = ymodem_wait_reply(serial_port, timer.timeout(attempt), stats)
+        if reply == ACK:
+            rtt = time.time() - t_write
+            # Karn: the ACK of a resent block cannot be matched to a write
+            if attempt == 0:
+                timer.sample(rtt)
+            if stats is not None:
+                stats.blocks += 1
+                stats.rtts.append(rtt)
             return True
-    return False
+        if reply == CAN:
+            return _fail(stats, "transfer cancelled by receiver")
+        naks = naks + 1 if reply == NAK else 0
+        if naks >= policy.max_naks:
+            return _fail(stats, f"block rejected {naks} times in a row")
+    return _fail(stats, f"no ACK after {policy.max_retries} retries")
+
+
+def ymodem_send_eot(serial_port, stats=None, timer=None):
+    # Receivers commonly NAK the first EOT, which is not a retransmission
+    if timer is None:
+        timer = AckTimer()
+    for attempt in range(timer.policy.max_retries + 1):
+        serial_port.write(bytes([EOT]))
+        reply = ymodem_wait_reply(serial_port, timer.timeout(attempt), stats)
+        if reply == ACK:
+            return True
+        if reply == CAN:
+            return _fail(stats, "transfer cancelled by receiver")
+    return _fail(stats, "EOT not acknowledged")
+
+
+def ymodem_cancel(serial_port):
+    # Two CANs abort the transfer on the receiving side
+    serial_port.write(bytes([CAN, CAN]))
+
+
+def ymodem_info_blk(file_name="", file_size=None):
+    # Block 0 carries "name\0size"; an empty one ends the batch
+    blkbuf = bytearray(133)
+    blkbuf[0] = SOH
+    blkbuf[1] = 0x00
+    blkbuf[2] = 0xff
+    if file_size is not None:
+        blkbuf[3:3+len(file_name)] = file_name.encode()
+        blkbuf[3+len(file_name)+1:3+len(file_name)+1 +
+               len(hex(file_size))] = hex(file_size).encode()
+
+    crc = CRC.calc_crc16(blkbuf[3:131])
+    blkbuf[131:133] = struct.pack('>H', crc)
+    return blkbuf
+
+
+def ymodem_data_blk(i_blk, data):
+    blkbuf = bytearray(1029)
+    blkbuf[0] = STX
+    blkbuf[1] = i_blk % 0x100
+    blkbuf[2] = 0xff - blkbuf[1]
+    blkbuf[3:3+len(data)] = data
+
+    crc = CRC.calc_crc16(memoryview(blkbuf)[3:1027])
+    blkbuf[1027:1029] = struct.pack('>H', crc)
+    return blkbuf
+
 
+def ymodem_data_blks(data):
+    for i_blk, pos in enumerate(range(0, len(data), 1024), 1):
+        yield ymodem_data_blk(i_blk, data[pos:pos+1024])
 
-def ymodem_xfer(serial_port, file_path, loaderboot):
-    file_size = loaderboot['length']
-    file_name = loaderboot['name']
-    offset = loaderboot['offset']
+
+class BlkPrefetcher:
+    """
+    Builds YMODEM data blocks on a worker thread into a bounded queue, so
+    the sender only has to write each block and wait for its ACK.
+    """
+    _END = object()
+
+    def __init__(self, blks, depth=YMODEM_PIPELINE_DEPTH):
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._produce, args=(blks,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, blks):
+        try:
+            for blk in blks:
+                if not self._put(blk):
+                    break
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(self._END)
+        finally:
+            blks.close()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def ymodem_xfer(serial_port, data, file_name, events=None, pipelined=True, stats=None,
+                timer=None):
+    """
+    Send one partition. data is any buffer, typically a zero-copy
+    Fwpkg.data() view. Pass an XferStats to collect retry and throughput
+    counters, an EventEmitter to receive (rate-limited) progress, and the
+    session's AckTimer so ACK timeouts carry over between partitions.
+    """
+    file_size = len(data)
     total_blk = (file_size + 1023) // 1024
-    last_blk = file_size % 1024 if file_size % 1024 else 1024
 
+    # Start framing data blocks while waiting for the receiver
+    blks = ymodem_data_blks(data)
+    if pipelined:
+        blks = BlkPrefetcher(blks)
+
+    if stats is None:
+        stats = XferStats()
+    if events is None:
+        events = EventEmitter()
+    if timer is None:
+        timer = AckTimer()
+    try:
+        return _ymodem_xfer(serial_port, file_name, file_size, total_blk, blks, events, stats,
+                            timer)
+    finally:
+        blks.close()
+
+
+def _ymodem_xfer(serial_port, file_name, file_size, total_blk, blks, events, stats, timer):
     # Waiting for C
     t0 = time.time()
     while True:
-        if serial_port.in_waiting > 0:
+        remaining = YMODEM_C_TIMEOUT - (time.time() - t0)
+        if remaining <= 0:
+            return _fail(stats, "receiver did not request the transfer")
+        if wait_readable(serial_port, remaining):
             cc = serial_port.read(1)
             if cc == bytes([C]):
                 break
-        if time.time() - t0 > YMODEM_C_TIMEOUT:
-            return False  # Timeout
+            if cc == bytes([CAN]):
+                return _fail(stats, "transfer cancelled by receiver")
 
     logging.debug(f"Xfer {file_name} ({file_size} B, {total_blk} BLK)")
 
     # Block 0: File Info
-    blkbuf = bytearray(133)
-    blkbuf[0] = SOH
-    blkbuf[1] = 0x00
-    blkbuf[2] = 0xff
-    blkbuf[3:3+len(file_name)] = file_name.encode()
-    blkbuf[3+len(file_name)+1:3+len(file_name)+1 +
-           len(hex(file_size))] = hex(file_size).encode()
-
-    crc = CRC.calc_crc16(blkbuf[3:131])
-    blkbuf[131:133] = struct.pack('>H', crc)
-
-    ret = ymodem_blk_timed_xmit(serial_port, blkbuf)
+    blkbuf = ymodem_info_blk(file_name, file_size)
+    ret = ymodem_blk_timed_xmit(serial_port, blkbuf, stats, timer)
     if ret is False:
         return False
 
     # Data Blocks: File Data
-    with open(file_path, 'rb') as f, Progress() as progress:
-        task = progress.add_task("[green]Transferring...", total=total_blk)
-        f.seek(offset)
-        for i_blk in range(1, total_blk + 1):
-            blkbuf = bytearray(1029)
-            blkbuf[0] = STX
-            blkbuf[1] = i_blk % 0x100
-            blkbuf[2] = 0xff - blkbuf[1]
-            rlen = last_blk if i_blk == total_blk else 1024
-            blkbuf[3:3+rlen] = f.read(rlen)
-
-            crc = CRC.calc_crc16(blkbuf[3:1027])
-            blkbuf[1027:1029] = struct.pack('>H', crc)
-
-            ret = ymodem_blk_timed_xmit(serial_port, blkbuf)
-            if ret is False:
-                return False
-            progress.update(task, advance=1)
+    t0 = time.time()
+    sent = 0
+    for blkbuf in blks:
+        ret = ymodem_blk_timed_xmit(serial_port, blkbuf, stats, timer)
+        if ret is False:
+            return False
+        sent += 1024
+        events.progress(min(sent, file_size), file_size, stats.retries)
+    events.progress(file_size, file_size, stats.retries, force=True)
+    stats.bytes += file_size
+    stats.elapsed += time.time() - t0
     # EOT
-    serial_port.write(bytes([EOT]))
-    while ymodem_wait_ack(serial_port) is False:
-        serial_port.write(bytes([EOT]))
+    if not ymodem_send_eot(serial_port, stats, timer):
+        return False
 
     # Block 0: Finish Xmit
-    blkbuf = bytearray(133)
-    blkbuf[0] = SOH
-    blkbuf[1] = 0x00
-    blkbuf[2] = 0xff
-    crc = CRC.calc_crc16(blkbuf[3:131])
-    blkbuf[131:133] = struct.pack('>H', crc)
-    ret = ymodem_blk_timed_xmit(serial_port, blkbuf)
+    blkbuf = ymodem_info_blk()
+    ret = ymodem_blk_timed_xmit(serial_port, blkbuf, stats, timer)
     if ret is False:
         return False
     return True
@@ -0,0 +1,43 @@
+import select
+import time
+
+# Poll interval for ports that cannot be waited on (no fileno, e.g. Windows)
+POLL_INTERVAL = 0.002
+
+
+def wait_readable(ser, timeout):
+    """
+    Block until ser has data to read or timeout seconds elapse, without
+    spinning the CPU. Returns True if data is available.
+    """
+    if ser.in_waiting > 0:
+        return True
+    # Ports that are not backed by a file, such as trace replays, may
+    # provide their own wait
+    wait = getattr(ser, "wait_readable", None)
+    if wait is not None:
+        return wait(timeout)
+    try:
+        fd = ser.fileno()
+    except (AttributeError, OSError, ValueError):
+        fd = None
+    if fd is not None:
+        readable, _, _ = select.select([fd], [], [], max(timeout, 0))
+        return bool(readable)
+    deadline = time.time() + timeout
+    while True:
+        if ser.in_waiting > 0:
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(POLL_INTERVAL, remaining))
+
+
+def open_serial(port, baudrate, timeout):
+    """
+    Default transport of Ws63BurnTools: a pyserial port.
+    """
+    import serial
+
+    return serial.Serial(port, baudrate, timeout=timeout)
@@ -0,0 +1,191 @@
+"""
+Resident flash station: watches for newly attached serial ports, queues a
+flash job per new device against a preloaded Fwpkg, and reports status as
+JSON over a local Unix socket.
+"""
+import glob
+import json
+import logging
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .events import STAGE_START
+from .ws63flash import Ws63BurnTools
+
+DEFAULT_PATTERNS = ['/dev/ttyUSB*', '/dev/ttyACM*']
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'autoburn.sock')
+SCAN_INTERVAL = 0.5
+# Give udev time to apply permissions to a new device node
+SETTLE_DELAY = 0.3
+
+
+def usb_device_id(port):
+    """
+    Identifier of the USB device behind port, or None if it has no serial
+    number (or is not a USB device).
+    """
+    from serial.tools.list_ports import comports
+
+    for info in comports():
+        if info.device == port and info.serial_number:
+            return f"usb:{info.vid or 0:04x}:{info.pid or 0:04x}:{info.serial_number}"
+    return None
+
+
+class FlashStation:
+    def __init__(self, fwpkg, patterns=None, workers=4, socket_path=None,
+                 include_present=False, **options) -> None:
+        """
+        options are passed to Ws63BurnTools for every job.
+        """
+        self.fwpkg = fwpkg
+        self.patterns = patterns or DEFAULT_PATTERNS
+        self.socket_path = socket_path
+        self.include_present = include_present
+        self.options = options
+        self.options['show_progress'] = False
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.started = time.time()
+        self.passed = 0
+        self.failed = 0
+        # port -> latest job of the device attached there
+        self.jobs = {}
+        self._present = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+
+    def ports(self):
+        ports = set()
+        for pattern in self.patterns:
+            ports.update(glob.glob(pattern))
+        return ports
+
+    def scan(self):
+        ports = self.ports()
+        for port in sorted(ports - self._present):
+            logging.info(f"{port} attached")
+            self.submit(port)
+        for port in sorted(self._present - ports):
+            logging.info(f"{port} detached")
+        self._present = ports
+
+    def submit(self, port):
+        with self._lock:
+            active = self.jobs.get(port)
+            if active is not None and active["state"] in ("queued", "running"):
+                # Fast unplug/replug: never run two sessions on one port
+                logging.warning(f"{port} still has a {active['state']} job, not queueing another")
+                return active
+        job = {"port": port, "state": "queued", "queued": time.time(),
+               "started": None, "duration": None, "stage": None, "partition": None,
+               "done": None, "total": None, "metrics": None}
+        with self._lock:
+            self.jobs[port] = job
+        self.pool.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        time.sleep(SETTLE_DELAY)
+        job["state"] = "running"
+        job["started"] = time.time()
+        options = dict(self.options)
+        if options.get("incremental"):
+            # Every board shows up on the same port path, key the manifest
+            # by the USB serial number instead
+            options["device_id"] = usb_device_id(job["port"])
+            if options["device_id"] is None:
+                logging.warning(f"{job['port']}: no USB serial number, flashing all partitions")
+                options["incremental"] = False
+        tools = Ws63BurnTools(job["port"], on_event=lambda event: self._track(job, event),
+                              **options)
+        try:
+            ok = tools.flash(self.fwpkg.name, self.fwpkg)
+        except Exception as e:
+            logging.error(f"{job['port']}: {e}")
+            ok = False
+        job["duration"] = time.time() - job["started"]
+        job["metrics"] = tools.metrics.to_dict()
+        with self._lock:
+            job["state"] = "pass" if ok else "fail"
+            if ok:
+                self.passed += 1
+            else:
+                self.failed += 1
+        logging.info(f"{job['port']}: {'PASS' if ok else 'FAIL'} in {job['duration']:.1f}s")
+
+    def _track(self, job, event):
+        # Live stage and byte counts for the status socket
+        if event.kind == STAGE_START:
+            job["stage"] = event.stage
+            job["partition"] = event.name
+        if event.done is not None:
+            job["done"] = event.done
+            job["total"] = event.total
+
+    def status(self):
+        with self._lock:
+            return {
+                "firmware": self.fwpkg.name,
+                "uptime": time.time() - self.started,
+                "workers": self.workers,
+                "passed": self.passed,
+                "failed": self.failed,
+                "present": sorted(self._present),
+                "jobs": [dict(job) for job in self.jobs.values()],
+            }
+
+    def _serve_socket(self):
+        station = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(json.dumps(station.status()).encode() + b"\n")
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        if not self.include_present:
+            self._present = self.ports()
+        if self.socket_path:
+            self._serve_socket()
+        logging.info(f"Station ready, watching {' '.join(self.patterns)}")
+        try:
+            while not self._stop.wait(SCAN_INTERVAL):
+                self.scan()
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self.socket_path)
+            self._server = None
+        self.pool.shutdown(wait=True)
+
+
+def query_status(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
@@ -0,0 +1,318 @@
+"""
+Serial session traces, to turn field sessions into reproducible tests.
+
+RecordingSerial wraps the port of a flash session and logs every read,
+write and control change with its timestamp to a compact binary trace.
+ReplaySerial stands in for the device and plays a trace back to the host
+code, at the original or an accelerated speed:
+
+    Ws63BurnTools(port, 921600, transport=recorder("field.trace")).flash("app.fwpkg")
+    Ws63BurnTools(port, 921600, transport=replayer("field.trace", speed=10)).flash("app.fwpkg")
+
+A trace is MAGIC and the start time (epoch seconds, double), followed by
+records of RECORD (kind, microseconds since start, payload length), each
+followed by its payload.
+"""
+import os
+import struct
+import time
+from collections import namedtuple
+
+from .serialio import open_serial
+
+MAGIC = b"WS63TRC\x01"
+HEADER = struct.Struct("<8sd")
+RECORD = struct.Struct("<BIH")
+MAX_PAYLOAD = 0xffff
+MAX_TIME = 0xffffffff
+
+# Bytes received by the host
+READ = ord('r')
+# Bytes sent by the host
+WRITE = ord('w')
+# Baud rate change, payload is the new rate as uint32
+BAUD = ord('b')
+# RTS level change, payload is one byte
+RTS = ord('t')
+# Input buffer discarded by the host
+FLUSH = ord('f')
+
+KIND_NAMES = {READ: 'read', WRITE: 'write', BAUD: 'baud', RTS: 'rts', FLUSH: 'flush'}
+
+# time: seconds since the start of the trace
+TraceRecord = namedtuple('TraceRecord', ['kind', 'time', 'data'])
+
+
+class TraceMismatch(IOError):
+    """
+    The host wrote something other than what the trace recorded.
+    """
+
+
+class TraceWriter:
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.start = time.monotonic()
+        stream.write(HEADER.pack(MAGIC, time.time()))
+
+    def record(self, kind, data=b""):
+        usec = min(int((time.monotonic() - self.start) * 1e6), MAX_TIME)
+        # Long payloads are split, replay treats both directions as streams
+        for i in range(0, max(len(data), 1), MAX_PAYLOAD):
+            chunk = data[i:i + MAX_PAYLOAD]
+            self.stream.write(RECORD.pack(kind, usec, len(chunk)))
+            self.stream.write(chunk)
+
+    def close(self):
+        self.stream.close()
+
+
+def read_trace(path):
+    """
+    Load a trace as a list of TraceRecord. Raises ValueError if the file
+    is not a trace or is truncated.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a serial trace")
+    records = []
+    pos = HEADER.size
+    while pos < len(data):
+        if pos + RECORD.size > len(data):
+            raise ValueError(f"{path}: truncated record at offset {pos}")
+        kind, usec, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        if kind not in KIND_NAMES or pos + length > len(data):
+            raise ValueError(f"{path}: bad record at offset {pos - RECORD.size}")
+        records.append(TraceRecord(kind, usec / 1e6, data[pos:pos + length]))
+        pos += length
+    return records
+
+
+def trace_summary(records):
+    """
+    Byte counts and duration of a trace, for display.
+    """
+    summary = {"duration": records[-1].time if records else 0.0, "read": 0, "write": 0,
+               "baudrates": []}
+    for record in records:
+        if record.kind == READ:
+            summary["read"] += len(record.data)
+        elif record.kind == WRITE:
+            summary["write"] += len(record.data)
+        elif record.kind == BAUD:
+            summary["baudrates"].append(struct.unpack("<I", record.data)[0])
+    return summary
+
+
+class RecordingSerial:
+    """
+    Pass-through wrapper of a serial port that records the session. Any
+    attribute not handled here (fileno, timeout, ...) goes to the port.
+    """
+
+    def __init__(self, ser, stream) -> None:
+        self.ser = ser
+        self.trace = TraceWriter(stream)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    @property
+    def baudrate(self):
+        return self.ser.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.ser.baudrate = baudrate
+        self.trace.record(BAUD, struct.pack("<I", baudrate))
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.trace.record(READ, bytes(data))
+        return data
+
+    def write(self, data):
+        written = self.ser.write(data)
+        if written is None:
+            written = len(data)
+        if written > 0:
+            self.trace.record(WRITE, bytes(data[:written]))
+        return written
+
+    def reset_input_buffer(self):
+        self.ser.reset_input_buffer()
+        self.trace.record(FLUSH)
+
+    def setRTS(self, level=True):
+        self.ser.setRTS(level)
+        self.trace.record(RTS, bytes([bool(level)]))
+
+    def close(self):
+        try:
+            self.ser.close()
+        finally:
+            self.trace.close()
+
+
+class ReplaySerial:
+    """
+    Serial port look-alike that answers from a trace. Each received chunk
+    is tied to the last write recorded before it and becomes readable
+    that long after the host repeats the write, divided by speed (0 for
+    no delay). Host side timers still run in real time.
+
+    Writes are checked against the trace; with strict a divergence raises
+    TraceMismatch, otherwise it is only counted in mismatches.
+    """
+
+    def __init__(self, records, speed=1.0, timeout=1, baudrate=115200, strict=True) -> None:
+        self.speed = speed
+        self.timeout = timeout
+        self.baudrate = baudrate
+        self.strict = strict
+        self.mismatches = 0
+
+        expected = bytearray()
+        # Stream offsets the host must reach before a chunk is scheduled
+        self._anchors = [0]
+        self._chunks = []
+        last_write = 0.0
+        for record in records:
+            if record.kind == WRITE:
+                expected += record.data
+                self._anchors.append(len(expected))
+                last_write = record.time
+            elif record.kind == READ:
+                self._chunks.append((len(self._anchors) - 1, record.time - last_write, record.data))
+        self._expected = bytes(expected)
+        self._written = 0
+        # Times at which the host reached each anchor
+        self._reached = [time.monotonic()]
+        self._next_chunk = 0
+        self._rx = bytearray()
+
+    @property
+    def finished(self):
+        """
+        True once the host wrote and read everything in the trace.
+        """
+        return self._written >= len(self._expected) and self._next_chunk == len(self._chunks) \
+            and not self._rx
+
+    def _due(self):
+        # Time the next chunk becomes readable, None if not scheduled yet
+        if self._next_chunk == len(self._chunks):
+            return None
+        anchor, delay, _ = self._chunks[self._next_chunk]
+        if anchor >= len(self._reached):
+            return None
+        return self._reached[anchor] + (delay / self.speed if self.speed > 0 else 0.0)
+
+    def _deliver(self):
+        # Chunks are handed out one at a time, so reads split the data
+        # where the recorded session did
+        if self._rx:
+            return None
+        due = self._due()
+        if due is not None and due <= time.monotonic():
+            self._rx += self._chunks[self._next_chunk][2]
+            self._next_chunk += 1
+            return None
+        return due
+
+    def _sleep(self, due, deadline):
+        now = time.monotonic()
+        if now >= deadline:
+            return False
+        time.sleep(max(min(deadline, due if due is not None else deadline) - now, 0))
+        return True
+
+    @property
+    def in_waiting(self):
+        self._deliver()
+        return len(self._rx)
+
+    def wait_readable(self, timeout):
+        """
+        Sleep until the next chunk is due, used by serialio.wait_readable.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            due = self._deliver()
+            if self._rx:
+                return True
+            if not self._sleep(due, deadline):
+                return False
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout or 0)
+        data = bytearray()
+        while len(data) < size:
+            due = self._deliver()
+            if self._rx:
+                take = size - len(data)
+                data += self._rx[:take]
+                del self._rx[:take]
+                continue
+            if not self._sleep(due, deadline):
+                break
+        return bytes(data)
+
+    def write(self, data):
+        data = bytes(data)
+        expected = self._expected[self._written:self._written + len(data)]
+        if expected != data:
+            self.mismatches += 1
+            if self.strict:
+                raise TraceMismatch(
+                    f"host wrote {data[:16].hex()} at offset {self._written}, "
+                    f"trace has {expected[:16].hex() or 'nothing'}")
+        self._written += len(data)
+        now = time.monotonic()
+        while len(self._reached) < len(self._anchors) \
+                and self._anchors[len(self._reached)] <= self._written:
+            self._reached.append(now)
+        return len(data)
+
+    def reset_input_buffer(self):
+        # The trace only holds bytes the host consumed, none to discard
+        pass
+
+    def setRTS(self, level=True):
+        pass
+
+    def close(self):
+        pass
+
+
+def _trace_path(path, port):
+    return path.replace("{port}", os.path.basename(port))
+
+
+def recorder(path, transport=open_serial):
+    """
+    Transport recording each session to path; "{port}" in path is
+    replaced by the port name, for concurrent sessions.
+    """
+    def open_recording(port, baudrate, timeout):
+        ser = transport(port, baudrate, timeout)
+        return RecordingSerial(ser, open(_trace_path(path, port), "wb"))
+    return open_recording
+
+
+def replayer(path, speed=1.0, strict=True):
+    """
+    Transport answering every session from the trace at path.
+    """
+    records = read_trace(path)
+
+    def open_replay(port, baudrate, timeout):
+        return ReplaySerial(records, speed, timeout, baudrate, strict)
+    return open_replay
@@ -1,26 +1,31 @@
-import struct
 import time
-from . import CRC
-from .pymodem import ymodem_xfer
-import serial
-from .fwpkg import Fwpkg
-import math
+from contextlib import contextmanager
+from .pymodem import RetryPolicy, XferStats, ymodem_cancel, ymodem_xfer
+from .fwpkg import open_fwpkg
+from .frame import (FrameParser, build_frame, download_frame, erase_size, handshake_frame,
+                    hexdump, reset_frame)
+from .manifest import BaudCache, Manifest, partition_record
+from .serialio import open_serial, wait_readable
+from .metrics import SessionMetrics
+from .events import SESSION_END, EventEmitter, RichProgress
 import logging
-from rich.logging import RichHandler
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(message)s",
-    handlers=[RichHandler()]
-)
 
 RESET_TIMEOUT = 10
+# Interval between handshake frames while waiting for the ROM
+HANDSHAKE_INTERVAL = 0.01
+HANDSHAKE_ACK = b"\xEF\xBE\xAD\xDE\x0C\x00\xE1\x1E"
+# How long RTS is held to reset the board
+RESET_PULSE = 0.1
 
 UART_READ_TIMEOUT = 5
 
-CMD_HANDSHAKE = 0
-CMD_DOWNLOAD = 1
-CMD_RST = 2
+# Baud rate negotiation: a rate is rejected if more than this share of
+# loaderboot blocks had to be resent, or after this many resends in total
+AUTO_BAUD_MAX_RETRY_RATE = 0.02
+AUTO_BAUD_MAX_RETRIES = 8
+
+# Time for the loaderboot to leave YMODEM after a cancel
+RESUME_SETTLE = 0.2
 
 AVAIL_BAUD = [
     115200,
@@ -35,32 +40,46 @@ AVAIL_BAUD = [
     2000000,
 ]
 
-WS63E_FLASHINFO = [
-    {
-        "cmd": 0xf0,
-        "data": [0x00, 0xc2, 0x01, 0x00, 0x08, 0x01, 0x00, 0x00],
-        "length": 8
-    },
-    {
-        "cmd": 0xd2,
-        "data": [0x00, 0x00, 0x00, 0x00,  # ADDR
-                 0x00, 0x00, 0x00, 0x00,  # ILEN
-                 0xFF, 0xFF, 0xFF, 0xFF,  # ERAS
-                 0x00, 0xFF],  # CONST
-        "length": 14
-    },
-    {
-        "cmd": 0x87,
-        "data": [0x00, 0x00],
-        "length": 2
-    }
-]
-
 
 class Ws63BurnTools:
-    def __init__(self, com, baudrate) -> None:
+    def __init__(self, com, baudrate, show_progress=True, incremental=False, device_id=None,
+                 auto_reset=False, handshake_interval=HANDSHAKE_INTERVAL,
+                 cache_baudrate=True, trim=False, on_event=None, retry_policy=None,
+                 resume_retries=0, transport=open_serial) -> None:
         self.com = com
+        # Opens the port as transport(com, baudrate, timeout), see trace.py
+        self.transport = transport
         self.baudrate = baudrate
+        # Render progress with rich unless on_event consumes the events
+        self.show_progress = show_progress
+        # Callable or queue receiving events.Event records of each session
+        self.on_event = on_event
+        self.events = EventEmitter(on_event, com)
+        # YMODEM ACK timeout bounds and retry limits, may be shared
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.ack_timer = self.retry_policy.timer()
+        # Failed partitions retried in place (or after reloading the
+        # loaderboot if the session is lost) before giving up
+        self.resume_retries = resume_retries
+        # Pulse RTS (wired to RESET) instead of waiting for a manual reset
+        self.auto_reset = auto_reset
+        self.handshake_interval = handshake_interval
+        # Remember the negotiated rate when baudrate is "auto"
+        self.cache_baudrate = cache_baudrate
+        self.baud_cache = BaudCache()
+        # Send partitions without trailing erased blocks, erase size unchanged
+        self.trim = trim
+        # Stage timings and YMODEM counters of the last flash() call
+        self.metrics = SessionMetrics(com)
+        # Skip partitions recorded as already written to this device
+        self.incremental = incremental
+        self.device_id = device_id
+        self.manifest = Manifest()
+
+    @contextmanager
+    def _stage(self, stage, name=None, total=None):
+        with self.metrics.stage(stage), self.events.stage(stage, name, total) as outcome:
+            yield outcome
 
     def set_com(self, com):
         self.com = com
@@ -68,166 +87,329 @@ class Ws63BurnTools:
     def set_baudrate(self, baudrate):
         self.baudrate = baudrate
 
-    def ws63_send_cmddef(self, cmddef):
-        total_bytes = cmddef['length'] + 10
-        buf = bytearray(total_bytes+12)
-
-        struct.pack_into('<I', buf, 0, 0xdeadbeef)
-
-        struct.pack_into('<H', buf, 4, total_bytes)
-
-        buf[6] = cmddef['cmd']
-        buf[7] = cmddef['cmd'] ^ 0xFF
-
-        buf[8:8 + cmddef['length']] = cmddef['data']
-
-        crc = CRC.calc_crc16(buf[:total_bytes - 2])
-        struct.pack_into('<H', buf, 8 + cmddef['length'], crc)
-        logging.debug("> " + ' '.join(f'{x:02x}' for x in buf))
-
+    def send_frame(self, frame):
+        # Formatting is skipped unless debug output is on
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"> {hexdump(frame)}")
         written = 0
-        while written < total_bytes:
-            wrote = self.ser.write(buf[written:total_bytes])
+        while written < len(frame):
+            wrote = self.ser.write(frame[written:])
             if wrote <= 0:
                 raise IOError("Error while writing to fd")
             written += wrote
 
-        logging.debug("> " + ' '.join(f'{x:02x}' for x in buf))
+    def ws63_send_cmddef(self, cmddef):
+        # {"cmd": ..., "data": ...} dict form of send_frame
+        self.send_frame(build_frame(cmddef['cmd'], bytes(cmddef['data'])))
 
     def uart_read_until_magic(self):
-        buf = bytearray(1024 + 12)
-        MAGIC = b'\xef\xbe\xad\xde'
-        i = 0
-        framelen = 0
-        st = 0
+        """
+        Wait for the next frame from the device and return it as a Frame,
+        or None on timeout, serial error or bad CRC.
+        """
+        import serial
+
         t0 = time.time()
 
         while True:
+            frame = self.frames.pop()
+            if frame is not None:
+                break
+
             # Abort if timeout is reached
             if time.time() - t0 > UART_READ_TIMEOUT:
                 logging.error("uart_read_until_magic: Timeout")
-                return -1  # Timeout error
+                return None  # Timeout error
 
             try:
-                # Read one byte
-                len_read = self.ser.read(1)
+                # Read whatever the current frame still needs, never past its end
+                data = self.ser.read(self.frames.want())
             except serial.SerialTimeoutException:
                 continue
             except serial.SerialException as e:
                 logging.error(f"uart_read_until_magic: {e}")
-                return -1
+                return None
 
-            if not len_read:
+            if not data:
                 continue
 
             # Update last valid char timer
             t0 = time.time()
+            self.frames.feed(data)
 
-            byte = len_read[0]
-            buf[i] = byte
-
-            # FSM states
-            if st == 0:
-                # Look for magic sequence
-                if MAGIC[i] == buf[i]:
-                    i += 1
-                    if i >= 4:
-                        st = 1
-                    continue
-                else:
-                    i = 0
-
-            elif st == 1:
-                if i == 5:  # Bytes 4:5 define framelen
-                    framelen = struct.unpack('<H', buf[4:6])[0]
-                elif i == framelen - 1:  # Reached end of frame
-                    break
-                i += 1
-                continue
-
-        # Check CRC
-        logging.debug("\n< " + ' '.join(f"{x:02x}" for x in buf[:i+1]))
-
-        crc_received = struct.unpack('<H', buf[framelen-2:framelen])[0]
-        crc_calculated = CRC.calc_crc16(buf[:framelen-2])
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"< cmd {frame.cmd:02x}: {hexdump(frame.payload)}")
 
-        if crc_received != crc_calculated:
+        if not frame.crc_ok:
             logging.warning("Warning: bad CRC from frame!")
-            return -1
-
-        return 0
-
-    def flash(self, name):
-        self.ser = serial.Serial(self.com, 115200, timeout=1)
-        self.ser.setRTS(False)
-        self.fwpkg = Fwpkg(name)
+            return None
+
+        return frame
+
+    def set_rts(self, level):
+        import serial
+
+        try:
+            self.ser.setRTS(level)
+        except (OSError, serial.SerialException) as e:
+            # Adapters and ptys without modem control lines
+            logging.debug(f"Unable to set RTS: {e}")
+
+    def reset_device(self):
+        self.set_rts(True)
+        time.sleep(RESET_PULSE)
+        self.set_rts(False)
+
+    def handshake(self, baudrate):
+        """
+        Send handshake frames every handshake_interval until the ROM ACKs,
+        sleeping on the port in between. Returns the time to handshake in
+        seconds, or None on timeout.
+        """
+        if self.auto_reset:
+            self.reset_device()
+        frame = handshake_frame(baudrate)
+        tail = b""
+        t0 = time.time()
+        next_send = t0
+        while True:
+            now = time.time()
+            if now - t0 > RESET_TIMEOUT:
+                return None
+            if now >= next_send:
+                self.send_frame(frame)
+                next_send = now + self.handshake_interval
+            if not wait_readable(self.ser, next_send - time.time()):
+                continue
+            # Keep the end of the last read in case the ACK is split
+            data = tail + self.ser.read(self.ser.in_waiting or 1)
+            if HANDSHAKE_ACK in data:
+                return time.time() - t0
+            tail = data[-(len(HANDSHAKE_ACK) - 1):]
+
+    def flash(self, name, fwpkg=None):
+        # fwpkg may be a parsed Fwpkg shared between concurrent sessions
+        self.metrics = SessionMetrics(self.com)
+        if fwpkg is None:
+            # Packages opened here are closed here, shared ones by their owner
+            with open_fwpkg(name) as fwpkg:
+                fwpkg.verify()
+                # Display bin information
+                fwpkg.show()
+                return self.flash(name, fwpkg)
+        self.fwpkg = fwpkg
         loaderboot = None
         for bin_info in self.fwpkg.bin_infos:
-            if bin_info['type'] == 0:
+            if bin_info.type == 0:
                 loaderboot = bin_info
                 break
         if not loaderboot:
             logging.error("Required loaderboot not found in fwpkg!")
-            return
-
-        # Display bin information
-        self.fwpkg.show()
-
-        # Stage 1: Flash loaderboot
+            return False
+
+        progress = RichProgress() if self.on_event is None and self.show_progress else None
+        self.events = EventEmitter(self.on_event or progress, self.com)
+        self.ser = self.transport(self.com, 115200, timeout=1)
+        ok = False
+        try:
+            if progress is not None:
+                progress.start()
+            self.set_rts(False)
+            ok = self._flash(loaderboot)
+            return ok
+        finally:
+            self.ser.close()
+            self.metrics.finish(ok)
+            self.events.emit(SESSION_END, None, ok=ok)
+            if progress is not None:
+                progress.stop()
+            logging.debug(f"{self.com} metrics: {self.metrics.to_dict()}")
+
+    def load_loaderboot(self, loaderboot, baudrate, stats=None):
+        # The ROM always talks 115200 until the handshake switches rates
+        self.ser.baudrate = 115200
+        self.ser.reset_input_buffer()
+        self.frames = FrameParser()
         logging.info("Waiting for device reset...")
-        t0 = time.time()
-        while True:
-            if time.time() - t0 > RESET_TIMEOUT:
-                logging.warning("Timeout while waiting for device reset")
-                return
-            WS63E_FLASHINFO[CMD_HANDSHAKE]["data"][0:4] = self.baudrate.to_bytes(
-                4, 'little')
-            # Handshake with device
-            self.ws63_send_cmddef(WS63E_FLASHINFO[CMD_HANDSHAKE])
-            # Read response and check for ACK
-            data = self.ser.read_all()
-            ack = b"\xEF\xBE\xAD\xDE\x0C\x00\xE1\x1E"
-            if ack in data:
-                self.ser.baudrate = self.baudrate
-                logging.info("Establishing ymodem session...")
-                break
+        with self._stage("handshake") as stage:
+            elapsed = self.handshake(baudrate)
+            stage.ok = elapsed is not None
+        if elapsed is None:
+            logging.warning("Timeout while waiting for device reset")
+            return False
+        self.ser.baudrate = baudrate
+        # ACK timing is learned again at every rate
+        self.ack_timer = self.retry_policy.timer()
+        logging.info(f"Handshake after {elapsed:.2f}s, establishing ymodem session...")
         time.sleep(0.5)
         # Entered YModem mode, transfer loaderboot
-        logging.info(f"Transferring {loaderboot['name']}...")
-        ret = ymodem_xfer(self.ser, name, loaderboot)
-        if ret is False:
-            logging.error(f"Error transferring {loaderboot['name']}")
-            return
+        logging.info(f"Transferring {loaderboot.name}...")
+        if stats is None:
+            stats = XferStats()
+        with self._stage("loaderboot", loaderboot.name, loaderboot.length) as stage:
+            ret = ymodem_xfer(self.ser, self.fwpkg.data(loaderboot),
+                              loaderboot.name, self.events, stats=stats, timer=self.ack_timer)
+            stage.ok = ret
+            if ret is False:
+                logging.error(f"Error transferring {loaderboot.name}: {stats.error}")
+                return False
 
-        self.uart_read_until_magic()
+            self.uart_read_until_magic()
+        self.metrics.add_partition(loaderboot.name, stats)
+        return True
+
+    def negotiate_baudrate(self, loaderboot):
+        """
+        Load the loaderboot at the fastest rate in AVAIL_BAUD that transfers
+        it reliably, falling back to slower rates (with a new reset) on
+        errors or excessive retransmits. Returns the chosen rate or None.
+        """
+        candidates = sorted(AVAIL_BAUD, reverse=True)
+        cached = self.baud_cache.get(self.com)
+        if cached in candidates:
+            candidates.remove(cached)
+            candidates.insert(0, cached)
+        for baudrate in candidates:
+            logging.info(f"Trying {baudrate} baud...")
+            stats = XferStats(max_retries=AUTO_BAUD_MAX_RETRIES)
+            if not self.load_loaderboot(loaderboot, baudrate, stats):
+                logging.warning(f"{baudrate} baud failed, falling back")
+                continue
+            if stats.retry_rate > AUTO_BAUD_MAX_RETRY_RATE:
+                logging.warning(f"{baudrate} baud unreliable ({stats.retries} retries "
+                                f"in {stats.blocks} blocks), falling back")
+                continue
+            logging.info(f"Using {baudrate} baud: {stats.throughput / 1024:.1f} KiB/s, "
+                         f"{stats.retries} retries, {stats.naks} NAKs")
+            if self.cache_baudrate:
+                self.baud_cache.set(self.com, baudrate, stats.throughput)
+            return baudrate
+        return None
+
+    def load(self, loaderboot):
+        """
+        Stage 1: reset into the ROM and start the loaderboot, at the
+        rate that carried it earlier in this session if there is one.
+        """
+        if self.metrics.baudrate is not None:
+            return self.load_loaderboot(loaderboot, self.metrics.baudrate)
+        if self.baudrate == "auto":
+            baudrate = self.negotiate_baudrate(loaderboot)
+            if baudrate is None:
+                logging.error("No usable baud rate found")
+                return False
+        else:
+            baudrate = self.baudrate
+            if not self.load_loaderboot(loaderboot, baudrate):
+                return False
+        # Only a rate that transferred the loaderboot is reused and reported
+        self.metrics.baudrate = baudrate
+        return True
+
+    def download(self, bin_info):
+        """
+        Erase and write one partition through the running loaderboot.
+        Returns True on success, False if the transfer failed but the
+        loaderboot answered CMD_DOWNLOAD, and None if it did not answer
+        (session lost).
+        """
+        length = self.fwpkg.trimmed_length(bin_info) if self.trim else bin_info.length
+        if length < bin_info.length:
+            logging.info(f"Transferring {bin_info.name} "
+                         f"({length} of {bin_info.length} bytes, rest is erased)...")
+        else:
+            logging.info(f"Transferring {bin_info.name}...")
+        # The erase always covers the whole partition, even when trimmed
+        frame = download_frame(bin_info.burn_addr, length, erase_size(bin_info.length))
+        t0 = time.time()
+        with self._stage("erase", bin_info.name) as stage:
+            self.send_frame(frame)
+            stage.ok = self.uart_read_until_magic() is not None
+        if not stage.ok:
+            return None
+        erase = time.time() - t0
+        stats = XferStats()
+        with self._stage("transfer", bin_info.name, length) as stage:
+            ret = ymodem_xfer(self.ser, self.fwpkg.data(bin_info)[:length],
+                              bin_info.name, self.events, stats=stats,
+                              timer=self.ack_timer)
+            stage.ok = ret
+        self.metrics.add_partition(bin_info.name, stats, erase)
+        if ret is False:
+            logging.error(f"Error transferring {bin_info.name}: {stats.error}")
+            return False
+        logging.debug(f"ACK timeout now {self.ack_timer.rto * 1000:.0f} ms")
+        return True
+
+    def abort_transfer(self):
+        # Get the loaderboot out of YMODEM and back to reading commands
+        ymodem_cancel(self.ser)
+        time.sleep(RESUME_SETTLE)
+        self.ser.reset_input_buffer()
+        self.frames = FrameParser()
+
+    def _flash(self, loaderboot):
+        budget = self.resume_retries
+        while not self.load(loaderboot):
+            if budget <= 0:
+                return False
+            budget -= 1
+            logging.warning(f"Reloading loaderboot ({budget} retries left)")
+            self.metrics.reloads += 1
 
         # Stage 2: Transfer other files
+        device = self.device_id or self.com
+        records = {}
         for bin_info in self.fwpkg.bin_infos:
-            if bin_info['type'] != 1:
+            if bin_info.type == 1:
+                records[bin_info.name] = partition_record(
+                    bin_info, self.fwpkg.digest(bin_info))
+        written = self.manifest.get(device) if self.incremental else {}
+        pending = []
+        for bin_info in self.fwpkg.bin_infos:
+            if bin_info.type != 1:
                 continue
-            logging.info(f"Transferring {bin_info['name']}...")
-            eras_size = math.ceil(bin_info['length'] / 8192.0) * 0x2000
-            WS63E_FLASHINFO[CMD_DOWNLOAD]["data"][0:4] = bin_info['burn_addr'].to_bytes(
-                4, 'little')
-            WS63E_FLASHINFO[CMD_DOWNLOAD]["data"][4:8] = bin_info['length'].to_bytes(
-                4, 'little')
-            WS63E_FLASHINFO[CMD_DOWNLOAD]["data"][8:12] = int(
-                eras_size).to_bytes(4, 'little')
-            self.ws63_send_cmddef(WS63E_FLASHINFO[CMD_DOWNLOAD])
-            self.uart_read_until_magic()
-            ret = ymodem_xfer(self.ser, name, bin_info)
-            if ret is False:
-                logging.error(f"Error transferring {bin_info['name']}")
-                return
-            time.sleep(0.1)
+            if written.get(bin_info.name) == records[bin_info.name]:
+                logging.info(f"Skipping {bin_info.name}, unchanged on device")
+                continue
+            pending.append(bin_info)
+        if pending:
+            # Only partitions known to be intact stay recorded, the rest are
+            # checkpointed one by one as they complete
+            self.manifest.update(device, {name: rec for name, rec in records.items()
+                                          if written.get(name) == rec})
+        while pending:
+            bin_info = pending[0]
+            result = self.download(bin_info)
+            if result:
+                self.manifest.record(device, bin_info.name, records[bin_info.name])
+                pending.pop(0)
+                time.sleep(0.1)
+                continue
+            if budget <= 0:
+                return False
+            budget -= 1
+            if result is None:
+                # Partitions already written survive the reset and are not resent
+                logging.warning(f"Session lost, reloading loaderboot ({budget} retries left)")
+                self.metrics.reloads += 1
+                if not self.load(loaderboot):
+                    return False
+            else:
+                logging.warning(f"Retrying {bin_info.name} ({budget} retries left)")
+                self.metrics.resumes += 1
+                self.abort_transfer()
+        self.manifest.update(device, records)
         logging.info("Done. Reseting device...")
-        self.ws63_send_cmddef(WS63E_FLASHINFO[CMD_RST])
-        self.uart_read_until_magic()
-        self.ser.close()
+        with self._stage("reset"):
+            self.send_frame(reset_frame())
+            self.uart_read_until_magic()
+        return True
 
 
 if __name__ == "__main__":
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+    from rich.logging import RichHandler
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[RichHandler()])
     tools = Ws63BurnTools("COM4", 921600)
     tools.flash("ws63-liteos-app_all_v1.10.T5.fwpkg")
@@ -0,0 +1,81 @@
+"""
+End-to-end flash benchmark against the pty WS63 emulator.
+
+    python benchmarks/bench_e2e.py [--size 2] [--baudrate 2000000] [--nak-rate 0.01]
+
+--trace records the session; --replay plays a recorded trace back instead
+of running the emulator (same --size/--partitions, the package is
+regenerated deterministically).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from synth import make_fwpkg  # noqa: E402
+from AutoBurn.emulator import Ws63Emulator  # noqa: E402
+from AutoBurn.fwpkg import Fwpkg  # noqa: E402
+from AutoBurn.trace import recorder, replayer  # noqa: E402
+from AutoBurn.ws63flash import Ws63BurnTools  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=float, default=2, help="app image size in MB")
+    parser.add_argument("--partitions", type=int, default=4)
+    parser.add_argument("--baudrate", type=int, default=2000000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--erase-delay", type=float, default=0.0)
+    parser.add_argument("--nak-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--trim", action="store_true", help="skip trailing erased blocks")
+    parser.add_argument("--stall-after", type=int, default=None,
+                        help="emulator goes silent once after this many data blocks")
+    parser.add_argument("--stall-time", type=float, default=1.0)
+    parser.add_argument("--stall-reboot", action="store_true",
+                        help="emulator restarts into the ROM after the stall")
+    parser.add_argument("--resume", type=int, default=0, help="resume retry budget")
+    parser.add_argument("--trace", default=None, help="record the session to this trace file")
+    parser.add_argument("--replay", default=None, help="replay this trace instead of the emulator")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 for no delays")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_fwpkg(os.path.join(tmp, "bench.fwpkg"),
+                          int(args.size * 1024 * 1024), args.partitions)
+        os.environ.setdefault("AUTOBURN_CACHE_DIR", tmp)
+        if args.replay:
+            with Fwpkg(path) as fwpkg:
+                tools = Ws63BurnTools("replay", args.baudrate, show_progress=False, trim=args.trim,
+                                      resume_retries=args.resume,
+                                      transport=replayer(args.replay, args.speed))
+                ok = intact = tools.flash(path, fwpkg) and tools.ser.finished
+        else:
+            with Fwpkg(path) as fwpkg, Ws63Emulator(
+                    latency=args.latency, erase_delay=args.erase_delay,
+                    nak_rate=args.nak_rate, drop_rate=args.drop_rate, seed=0,
+                    stall_after=args.stall_after, stall_time=args.stall_time,
+                    stall_reboot=args.stall_reboot) as emu:
+                options = {"transport": recorder(args.trace)} if args.trace else {}
+                tools = Ws63BurnTools(emu.port, args.baudrate, show_progress=False, trim=args.trim,
+                                      resume_retries=args.resume, **options)
+                ok = tools.flash(path, fwpkg)
+                intact = ok and all(emu.read_flash(b.burn_addr, b.length) == fwpkg.data(b)
+                                    for b in fwpkg.bin_infos if b.type == 1)
+
+    report = tools.metrics.to_dict()
+    total = sum(p["bytes"] for p in report["partitions"])
+    print(json.dumps(report, indent=2))
+    print(f"result: {'PASS' if ok and intact else 'FAIL'}, "
+          f"{total / 1024:.0f} KiB in {report['duration']:.2f}s, "
+          f"transfer {sum(p['seconds'] for p in report['partitions']):.2f}s")
+    sys.exit(0 if ok and intact else 1)
+
+
+if __name__ == "__main__":
+    main()
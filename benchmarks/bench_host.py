@@ -0,0 +1,214 @@
+"""
+Host-side microbenchmarks: CRC, YMODEM block building, command frames,
+reply parsing and fwpkg parsing, on synthetic packages.
+
+    python benchmarks/bench_host.py [--sizes 1,2,4,8] [--check] [--save]
+
+Throughputs are in MB/s (higher is better), per-call costs in us (lower
+is better). --check compares against baseline.json and fails on any
+result worse by more than --threshold; --save replaces the baseline.
+Baselines are machine specific, save one before comparing changes.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bench_crc import cross_check  # noqa: E402
+from synth import make_fwpkg  # noqa: E402
+from AutoBurn import CRC  # noqa: E402
+from AutoBurn.frame import (  # noqa: E402
+    CMD_ACK, CMD_DOWNLOAD, FRAME_HEADER_SIZE, FrameParser, build_frame, download_frame)
+from AutoBurn.fwpkg import Fwpkg  # noqa: E402
+from AutoBurn.pymodem import ACK, C, ymodem_data_blk, ymodem_data_blks, ymodem_xfer  # noqa: E402
+from AutoBurn.ws63flash import Ws63BurnTools  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+MB = 1024 * 1024
+# Calls per sample for the per-call benchmarks
+CALLS = 2000
+ACK_FRAME = build_frame(CMD_ACK, b'\x5a\x00')
+
+
+class MemoryPort:
+    """
+    Serial port stand-in: reads are served from rx, writes are dropped.
+    With auto_ack every write is answered with a YMODEM ACK, so
+    ymodem_xfer runs at host speed.
+    """
+
+    def __init__(self, rx=b"", auto_ack=False) -> None:
+        self.rx = bytearray(rx)
+        self.auto_ack = auto_ack
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def write(self, data):
+        if self.auto_ack:
+            self.rx.append(ACK)
+        return len(data)
+
+
+def best(func, repeat):
+    # Best of repeat runs, the least disturbed by the rest of the system
+    elapsed = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = min(elapsed, time.perf_counter() - t0)
+    return elapsed
+
+
+def throughput(func, size, repeat):
+    return size / best(func, repeat) / 1e6
+
+
+def per_call(func, repeat, calls=CALLS):
+    def loop():
+        for _ in range(calls):
+            func()
+    return best(loop, repeat) / calls * 1e6
+
+
+def tools_on(port):
+    tools = Ws63BurnTools("bench", 921600, show_progress=False)
+    tools.ser = port
+    tools.frames = FrameParser()
+    return tools
+
+
+def bench_frames(repeat):
+    results = {}
+    blk = bytes(range(256)) * 4
+    results["crc16 1029B block"] = (per_call(lambda: CRC.calc_crc16(blk), repeat), "us")
+    results["ymodem_data_blk"] = (per_call(lambda: ymodem_data_blk(1, blk), repeat), "us")
+    results["download_frame"] = (
+        per_call(lambda: download_frame(0x230000, 0x1a0000, 0x1a0000), repeat), "us")
+
+    tools = tools_on(MemoryPort())
+    frame = download_frame(0x230000, 0x1a0000, 0x1a0000)
+    results["send_frame"] = (per_call(lambda: tools.send_frame(frame), repeat), "us")
+    cmddef = {"cmd": CMD_DOWNLOAD, "data": frame[FRAME_HEADER_SIZE:-2]}
+    results["ws63_send_cmddef"] = (per_call(lambda: tools.ws63_send_cmddef(cmddef), repeat), "us")
+
+    def read_frames():
+        tools.ser = MemoryPort(ACK_FRAME * CALLS)
+        for _ in range(CALLS):
+            tools.uart_read_until_magic()
+    results["uart_read_until_magic"] = (best(read_frames, repeat) / CALLS * 1e6, "us")
+
+    parser = FrameParser()
+
+    def parse_frames():
+        parser.feed(ACK_FRAME * CALLS)
+        while parser.pop() is not None:
+            pass
+    results["FrameParser bulk"] = (best(parse_frames, repeat) / CALLS * 1e6, "us")
+    return results
+
+
+def bench_package(path, size_mb, repeat):
+    results = {}
+    size = os.path.getsize(path)
+
+    def parse():
+        Fwpkg(path).close()
+    results[f"Fwpkg parse {size_mb}MB"] = (per_call(parse, repeat, 200), "us")
+
+    with Fwpkg(path) as fwpkg:
+        app = next(b for b in fwpkg.bin_infos if b.name == "app")
+        data = fwpkg.data(app)
+        results[f"crc16 {size_mb}MB"] = (
+            throughput(lambda: CRC.calc_crc16(data), len(data), repeat), "MB/s")
+        results[f"Fwpkg verify {size_mb}MB"] = (
+            throughput(lambda: fwpkg.verify(use_index=False), size, repeat), "MB/s")
+        results[f"trimmed_length {size_mb}MB"] = (throughput(
+            lambda: [fwpkg.trimmed_length(b) for b in fwpkg.bin_infos], size, repeat), "MB/s")
+        results[f"ymodem_data_blks {size_mb}MB"] = (
+            throughput(lambda: sum(1 for _ in ymodem_data_blks(data)), len(data), repeat), "MB/s")
+
+        def xfer():
+            # Host overhead of a whole transfer against an instant receiver
+            assert ymodem_xfer(MemoryPort(bytes([C]), auto_ack=True), data, app.name)
+        results[f"ymodem_xfer {size_mb}MB"] = (throughput(xfer, len(data), repeat), "MB/s")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Names of results worse than their baseline by more than threshold.
+    """
+    regressions = []
+    for name, (value, unit) in results.items():
+        base = baseline.get(name)
+        if base is None or base["unit"] != unit:
+            continue
+        ratio = value / base["value"] if unit == "MB/s" else base["value"] / value
+        if ratio < 1 - threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1,2,4,8", help="package sizes in MB")
+    parser.add_argument("--partitions", type=int, default=Fwpkg.MAX_PARTITION_CNT)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=0.3,
+                        help="allowed slowdown before --check fails, as a fraction")
+    parser.add_argument("--check", action="store_true", help="exit 1 on regressions")
+    parser.add_argument("--save", action="store_true", help="store results as the baseline")
+    args = parser.parse_args()
+
+    cross_check()
+    print(f"crc backend: {CRC.BACKEND}, cross-check OK")
+
+    results = bench_frames(args.repeat)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in [int(s) for s in args.sizes.split(",")]:
+            path = make_fwpkg(os.path.join(tmp, f"bench{size_mb}.fwpkg"),
+                              size_mb * MB, args.partitions)
+            results.update(bench_package(path, size_mb, args.repeat))
+
+    try:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+    regressions = compare(results, baseline, args.threshold)
+    for name, (value, unit) in results.items():
+        line = f"{name:<28} {value:10.2f} {unit:<5}"
+        if name in baseline:
+            line += f" baseline {baseline[name]['value']:10.2f}"
+        if name in regressions:
+            line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({name: {"value": round(value, 3), "unit": unit}
+                       for name, (value, unit) in results.items()}, f, indent=1)
+            f.write("\n")
+        print(f"baseline saved to {args.baseline}")
+    if args.check:
+        if not baseline:
+            sys.exit(f"no baseline at {args.baseline}, run with --save first")
+        if regressions:
+            sys.exit(f"{len(regressions)} regressions over {args.threshold:.0%}")
+        print(f"no regressions over {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
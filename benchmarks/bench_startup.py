@@ -0,0 +1,54 @@
+"""
+CLI startup time and import hygiene check.
+
+    python benchmarks/bench_startup.py [--runs 10]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Modules that must only be loaded once a command actually needs them
+DEFERRED = ["rich", "serial", "tarfile", "zipfile", "gzip"]
+
+CHECK = (
+    "import sys, AutoBurn.autoBurn, AutoBurn.ws63flash, AutoBurn.fwpkg, AutoBurn.pymodem\n"
+    "print(' '.join(m for m in {!r} if m in sys.modules))\n"
+).format(DEFERRED)
+
+CASES = [
+    ("python (baseline)", ["-c", "pass"]),
+    ("import AutoBurn.autoBurn", ["-c", "import AutoBurn.autoBurn"]),
+    ("burn --help", ["-m", "AutoBurn.autoBurn", "--help"]),
+]
+
+
+def run(args):
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    loaded = subprocess.run([sys.executable, "-c", CHECK], cwd=ROOT, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    if loaded:
+        sys.exit(f"eagerly imported: {', '.join(loaded)}")
+    print("import hygiene OK")
+
+    for name, case in CASES:
+        samples = sorted(run(case) for _ in range(args.runs))
+        print(f"{name:<26} min {samples[0] * 1000:7.1f} ms  "
+              f"median {samples[len(samples) // 2] * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
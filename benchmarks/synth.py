@@ -0,0 +1,41 @@
+"""
+Synthetic fwpkg files for the benchmarks.
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from AutoBurn.fwpkg import Fwpkg, FwpkgWriter  # noqa: E402
+
+
+def make_image(size, fill_ratio=0.25, seed=0):
+    """
+    Random image whose last fill_ratio is erased flash (0xFF), like a
+    typical app image with reserved space.
+    """
+    used = size - int(size * fill_ratio)
+    return random.Random(seed).getrandbits(8 * used).to_bytes(used, "little") + b'\xff' * (size - used)
+
+
+def make_fwpkg(path, app_size=2 * 1024 * 1024, partitions=4, loaderboot_size=24 * 1024):
+    """
+    Write a package with a loaderboot, an app image of app_size bytes and
+    partitions - 2 small images, capped at Fwpkg.MAX_PARTITION_CNT.
+    """
+    partitions = max(2, min(partitions, Fwpkg.MAX_PARTITION_CNT))
+    bins = [("loaderboot", make_image(loaderboot_size, 0, 1), 0x0, 0)]
+    addr = 0x200000
+    bins.append(("app", make_image(app_size, 0.25, 2), addr, 1))
+    addr += app_size
+    for i in range(partitions - 2):
+        size = 8 * 1024
+        bins.append((f"part{i}", make_image(size, 0.5, 3 + i), addr, 1))
+        addr += size
+
+    writer = FwpkgWriter()
+    for name, data, burn_addr, type_ in bins:
+        writer.add(name, data, burn_addr, type_)
+    writer.write(path)
+    return path
@@ -21,6 +21,6 @@ setup(
     ],
     entry_points='''
         [console_scripts]
-        burn=AutoBurn.autoBurn:flash_firmware
+        burn=AutoBurn.autoBurn:cli
     ''',
 )
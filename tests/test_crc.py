@@ -0,0 +1,49 @@
+import importlib
+import random
+
+import pytest
+
+from AutoBurn import CRC
+
+LENGTHS = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 15, 17, 1023, 1029] + \
+    random.Random(0x63).sample(range(10, 5000), 20)
+
+
+@pytest.fixture(params=["fast", "python", "unknown"])
+def crc(request, monkeypatch):
+    monkeypatch.setenv("AUTOBURN_CRC_BACKEND", request.param)
+    yield importlib.reload(CRC)
+    monkeypatch.undo()
+    importlib.reload(CRC)
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+def test_backends_match_reference(crc, length):
+    rng = random.Random(length)
+    data = bytes(rng.getrandbits(8) for _ in range(length))
+    for init in (0, 0x1d0f, 0xffff):
+        assert crc.calc_crc16(data, init) == crc.calc_crc16_py(data, init)
+        assert crc.calc_crc16(memoryview(data), init) == crc.calc_crc16_py(data, init)
+    for init in (0, 0xdeadbeef, 0xffffffff):
+        assert crc.calc_crc32(data, init) == crc.calc_crc32_py(data, init)
+        assert crc.calc_crc32(memoryview(data), init) == crc.calc_crc32_py(data, init)
+    # Chained updates match a single pass
+    half = length // 2
+    assert crc.calc_crc32(data[half:], crc.calc_crc32(data[:half])) == crc.calc_crc32(data)
+
+
+@pytest.mark.parametrize("length", [0, 1, 7, 9, 100])
+def test_iterables_of_ints(crc, length):
+    data = [i * 37 & 0xff for i in range(length)]
+    assert crc.calc_crc16(data) == crc.calc_crc16_py(bytes(data))
+    assert crc.calc_crc32(data) == crc.calc_crc32_py(bytes(data))
+    assert crc.calc_crc32(iter(data)) == crc.calc_crc32_py(bytes(data))
+
+
+def test_backend_selection(monkeypatch):
+    monkeypatch.setenv("AUTOBURN_CRC_BACKEND", "python")
+    assert importlib.reload(CRC).calc_crc32 is CRC.calc_crc32_py
+    monkeypatch.setenv("AUTOBURN_CRC_BACKEND", "bogus")
+    assert importlib.reload(CRC).BACKEND == "fast"
+    monkeypatch.undo()
+    importlib.reload(CRC)
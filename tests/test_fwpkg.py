@@ -0,0 +1,61 @@
+import os
+import shlex
+
+import pytest
+from click.testing import CliRunner
+
+from AutoBurn.autoBurn import cli
+from AutoBurn.fwpkg import BinInfo, Fwpkg, FwpkgWriter, check_bin_name
+
+LOADER = bytes(range(256)) * 2
+
+
+def build(path, names):
+    writer = FwpkgWriter()
+    writer.add("loader", LOADER, 0, 0)
+    for i, name in enumerate(names):
+        data = bytes([i + 1]) * (100 + i)
+        # Appended directly so that names the writer refuses can be tested
+        writer.entries.append((BinInfo(name, None, len(data), 0x1000 * (i + 1), len(data), 1),
+                               data))
+    writer.write(str(path))
+    return str(path)
+
+
+@pytest.mark.parametrize("name", ["app", "app..v2", "fw..bak", "...", "my app", "a.b"])
+def test_plain_names_allowed(name):
+    check_bin_name(name)
+    FwpkgWriter().add(name, b"\x00" * 4, 0x1000)
+
+
+@pytest.mark.parametrize("name", ["", ".", "..", "../escaped", "a/b", "a\\b", "a\x00b"])
+def test_path_names_rejected(name):
+    with pytest.raises(ValueError):
+        check_bin_name(name)
+    with pytest.raises(ValueError):
+        FwpkgWriter().add(name, b"\x00" * 4, 0x1000)
+
+
+def test_unpack_rejects_escaping_names(tmp_path):
+    pkg = build(tmp_path / "evil.fwpkg", ["../escaped"])
+    out = tmp_path / "out" / "x"
+    result = CliRunner().invoke(cli, ["unpack", "-o", str(out), pkg])
+    assert result.exit_code == 1
+    assert "Bad bin name" in result.output
+    assert not (tmp_path / "out").exists()
+
+
+def test_unpack_pack_round_trip(tmp_path):
+    pkg = build(tmp_path / "in.fwpkg", ["app..v2", "my app"])
+    out = tmp_path / "un pk"
+    runner = CliRunner()
+    result = runner.invoke(cli, ["unpack", "-o", str(out), pkg])
+    assert result.exit_code == 0, result.output
+    assert sorted(os.listdir(out)) == ["app..v2.bin", "loader.bin", "my app.bin"]
+
+    repacked = str(tmp_path / "out.fwpkg")
+    result = runner.invoke(cli, ["pack", "-o", repacked] + shlex.split(result.output))
+    assert result.exit_code == 0, result.output
+    with Fwpkg(pkg) as a, Fwpkg(repacked) as b:
+        assert a.bin_infos == b.bin_infos
+        assert all(a.data(x) == b.data(x) for x in a.bin_infos)
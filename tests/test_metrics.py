@@ -0,0 +1,52 @@
+from AutoBurn.metrics import METRIC_HELP, SessionMetrics, write_prometheus
+from AutoBurn.pymodem import XferStats
+
+
+def session(port, rtts):
+    m = SessionMetrics(port)
+    stats = XferStats()
+    stats.bytes, stats.blocks, stats.elapsed = 1024 * len(rtts), len(rtts), 0.1
+    stats.rtts = rtts
+    m.add_partition("app", stats)
+    m.finish(True)
+    return m
+
+
+def families(text):
+    # metric family -> sample lines, in file order
+    result = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            current = line.split()[2]
+            assert current not in result, f"{current} declared twice"
+            result[current] = []
+        else:
+            assert current is not None and line.startswith(current), line
+            result[current].append(line)
+    return result
+
+
+def test_summary_sum_and_count_written(tmp_path):
+    path = tmp_path / "autoburn.prom"
+    write_prometheus(str(path), [session("/dev/ttyUSB0", [0.001, 0.002, 0.004]),
+                                 session("/dev/ttyUSB1", [])])
+    text = path.read_text(encoding="utf-8")
+    assert text.endswith("\n")
+    samples = families(text)
+    assert [h.split()[2] for h in METRIC_HELP] == list(samples)
+
+    rtt = samples["autoburn_ack_rtt_seconds"]
+    assert 'autoburn_ack_rtt_seconds_sum{port="/dev/ttyUSB0"} 0.007000' in rtt
+    assert 'autoburn_ack_rtt_seconds_count{port="/dev/ttyUSB0"} 3' in rtt
+    assert 'autoburn_ack_rtt_seconds_sum{port="/dev/ttyUSB1"} 0.000000' in rtt
+    assert 'autoburn_ack_rtt_seconds_count{port="/dev/ttyUSB1"} 0' in rtt
+    assert sum('quantile="' in line for line in rtt) == 6
+
+
+def test_every_sample_is_written(tmp_path):
+    path = tmp_path / "autoburn.prom"
+    sessions = [session("/dev/ttyUSB0", [0.001])]
+    write_prometheus(str(path), sessions)
+    written = set(path.read_text(encoding="utf-8").splitlines())
+    assert set(sessions[0].prometheus_lines()) <= written